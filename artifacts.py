@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from configparser import ConfigParser
+
+from logger import logger
+
+ARTIFACT_PATH = "./solutions/artifacts"
+DEFAULT_RETENTION_DAYS = 14
+DEFAULT_MAX_ENTRIES = 50
+
+
+def file_hash(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ArtifactStore:
+    """
+    Content-addressed store for exported solution zips.
+
+    Exports are indexed by environment, solution, version and managed flag and stored once per
+    content hash, so equal exports of different environments or versions share one file.
+    Entries which were not used within the retention period or exceed the maximum count are evicted.
+    Implements the singleton pattern to ensure only one instance exists.
+    """
+
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._initialize(*args, **kwargs)
+        return cls._instance
+
+    def _initialize(self, path: str = ARTIFACT_PATH):
+        config = ConfigParser()
+        config.read("conf.ini")
+
+        self.retention = config.getint("Options", "ArtifactRetentionDays", fallback=DEFAULT_RETENTION_DAYS) * 86400
+        self.max_entries = config.getint("Options", "ArtifactMaxEntries", fallback=DEFAULT_MAX_ENTRIES)
+        self.path = path
+        self.blobs = os.path.join(path, "blobs")
+        self.index_file = os.path.join(path, "index.json")
+        self._lock = threading.Lock()
+
+        os.makedirs(self.blobs, exist_ok=True)
+
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                self.index: dict[str, dict] = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.index = {}
+
+    @staticmethod
+    def key(environment, solution_name: str, version: str, managed: bool) -> str:
+        return f"{environment}/{solution_name}/{version}/{'managed' if managed else 'unmanaged'}"
+
+    def _blob(self, sha: str) -> str:
+        return os.path.join(self.blobs, f"{sha}.zip")
+
+    def _save_index(self):
+        tmp = self.index_file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.index, f, indent=4)
+        os.replace(tmp, self.index_file)
+
+    def get(self, environment, solution_name: str, version: str, managed: bool) -> str | None:
+        """
+        :return: Path of the cached export or None if there is none
+        """
+        key = self.key(environment, solution_name, version, managed)
+
+        with self._lock:
+            entry = self.index.get(key)
+
+            if entry is None or not os.path.exists(self._blob(entry["sha256"])):
+                return None
+
+            entry["last_used"] = time.time()
+            self._save_index()
+
+        logger().log(f"Using cached export {key} ({entry['sha256'][:12]})")
+        return self._blob(entry["sha256"])
+
+    def put(self, environment, solution_name: str, version: str, managed: bool, file: str) -> str:
+        """
+        Moves an exported zip into the store.
+        :param file: Path of the exported zip, the file is moved
+        :return: Path of the stored export
+        """
+        sha = file_hash(file)
+        key = self.key(environment, solution_name, version, managed)
+
+        with self._lock:
+            if os.path.exists(self._blob(sha)):
+                os.remove(file)
+            else:
+                shutil.move(file, self._blob(sha))
+
+            now = time.time()
+            self.index[key] = {"sha256": sha, "created": now, "last_used": now}
+            self._save_index()
+
+        logger().log(f"Stored export {key} ({sha[:12]})")
+        self.evict()
+
+        return self._blob(sha)
+
+    def evict(self):
+        """
+        Removes entries past the retention period or beyond the maximum count, then unreferenced files.
+        """
+        with self._lock:
+            now = time.time()
+            entries = sorted(self.index.items(), key=lambda item: item[1]["last_used"], reverse=True)
+            keep = {
+                key: entry
+                for i, (key, entry) in enumerate(entries)
+                if i < self.max_entries and now - entry["last_used"] <= self.retention
+            }
+
+            if len(keep) != len(self.index):
+                logger().log(f"Evicting {len(self.index) - len(keep)} cached exports")
+                self.index = keep
+                self._save_index()
+
+            referenced = {entry["sha256"] for entry in self.index.values()}
+            for file in os.listdir(self.blobs):
+                if file.endswith(".zip") and file[:-4] not in referenced:
+                    os.remove(os.path.join(self.blobs, file))
+
+
+def artifacts() -> ArtifactStore:
+    return ArtifactStore()
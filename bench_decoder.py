@@ -0,0 +1,101 @@
+"""
+Microbenchmark of the json decoding of a Web API page.
+
+Compares the current path (bytes -> str -> json.loads, like `requests.Response.json`) with the
+decoder layer for every available backend, decoding the whole page and parsing it incrementally.
+The incremental parser needs more CPU than decoding the whole page, its gain is that rows are
+available while the rest of the page is still downloading.
+
+Usage: python bench_decoder.py [rows] [repeats]
+"""
+import json
+import sys
+import time
+import uuid
+
+import decoder
+
+CHUNK_SIZE = 64 * 1024
+
+
+def build_page(rows: int) -> bytes:
+    """
+    Builds a page shaped like an `accounts` response with lookup annotations.
+    """
+    value = []
+    for i in range(rows):
+        row = {
+            "@odata.etag": f'W/"{1000000 + i}"',
+            "accountid": str(uuid.uuid4()),
+            "name": f"Sample Account {i} äöü",
+            "accountnumber": f"ACC-{i:06d}",
+            "description": "Lorem ipsum dolor sit amet, \"consectetur\" {adipiscing} [elit]." * 3,
+            "revenue": i * 1000.5,
+            "numberofemployees": i,
+            "createdon": "2024-07-01T12:00:00Z",
+            "modifiedon": "2024-07-02T12:00:00Z",
+            "statecode": 0,
+            "statuscode": 1,
+            "address1_city": "Berlin",
+            "address1_postalcode": "10115",
+        }
+        for lookup in ["primarycontactid", "ownerid", "parentaccountid", "transactioncurrencyid"]:
+            row[f"_{lookup}_value"] = str(uuid.uuid4())
+            row[f"_{lookup}_value@Microsoft.Dynamics.CRM.lookuplogicalname"] = lookup[:-2]
+        value.append(row)
+
+    return json.dumps(
+        {
+            "@odata.context": "https://myxrm-dev01.crm4.dynamics.com/api/data/v9.2/$metadata#accounts",
+            "value": value,
+            "@odata.nextLink": "https://myxrm-dev01.crm4.dynamics.com/api/data/v9.2/accounts?$skiptoken=1",
+        },
+        ensure_ascii=False,
+    ).encode("utf-8")
+
+
+def current_path(data: bytes) -> list:
+    return json.loads(data.decode("utf-8"))["value"]
+
+
+def whole_page(data: bytes) -> list:
+    return decoder.loads(data)["value"]
+
+
+def incremental(data: bytes) -> list:
+    chunks = (data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE))
+    return list(decoder.iter_values(chunks))
+
+
+def measure(function, data: bytes, repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(data)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    data = build_page(rows)
+    expected = current_path(data)
+
+    print(f"Page with {rows} rows, {len(data) / 1024 / 1024:.1f} MiB, best of {repeats}")
+
+    baseline = measure(current_path, data, repeats)
+    print(f"{'current (str + json.loads)':<32}{baseline * 1000:>10.1f} ms")
+
+    for name in list(decoder._backends):
+        decoder.use_backend(name)
+
+        for label, function in [("whole page", whole_page), ("incremental", incremental)]:
+            assert function(data) == expected
+            seconds = measure(function, data, repeats)
+            print(f"{f'{name} {label}':<32}{seconds * 1000:>10.1f} ms{baseline / seconds:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
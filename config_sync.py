@@ -0,0 +1,184 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from journal import Journal, JournalStatus
+from misc import to_field_name
+from msal_app import crm, BATCH_SIZE
+from profiler import inherit
+
+CONFIGURATION_SETTINGS = "afd_configurationsettings"
+
+# Fields maintained by the system, they differ between environments and can not be written
+SYSTEM_FIELDS = {
+    "createdon",
+    "modifiedon",
+    "overriddencreatedon",
+    "versionnumber",
+    "importsequencenumber",
+    "timezoneruleversionnumber",
+    "utcconversiontimezonecode",
+}
+
+
+def comparable(row: dict) -> dict:
+    """
+    Returns the writable fields of a raw row, without annotations, lookups and system fields.
+    """
+    return {
+        key: value
+        for key, value in row.items()
+        if "@" not in key and not key.startswith("_") and key not in SYSTEM_FIELDS
+    }
+
+
+class SyncPlan:
+    """
+    Difference between the rows of an entity in two systems, indexed by a key field.
+    """
+
+    def __init__(self, entity: str, key: str):
+        self.entity = entity
+        self.key = key
+        self.id_field = to_field_name(entity)
+
+        # Tuples of key and payload
+        self.creates: list[tuple[str, dict]] = []
+        # Tuples of key, target id and changed fields
+        self.updates: list[tuple[str, str, dict]] = []
+        # Tuples of key and target id
+        self.deletes: list[tuple[str, str]] = []
+        self.unchanged = 0
+
+    def operations(self) -> list[tuple[JournalStatus, str, str | None, tuple]]:
+        """
+        :return: Tuples of the journal status on success, key, target id and batch operation
+        """
+        return [
+            *[
+                (JournalStatus.CREATED, key, payload.get(self.id_field), ("POST", self.entity, None, payload))
+                for key, payload in self.creates
+            ],
+            *[
+                (JournalStatus.UPDATED, key, id, ("PATCH", self.entity, id, fields))
+                for key, id, fields in self.updates
+            ],
+            *[
+                (JournalStatus.DELETED, key, id, ("DELETE", self.entity, id, None))
+                for key, id in self.deletes
+            ],
+        ]
+
+    def to_dict(self) -> dict:
+        return {
+            "create": len(self.creates),
+            "update": len(self.updates),
+            "delete": len(self.deletes),
+            "unchanged": self.unchanged,
+            "changed_fields": {key: sorted(fields) for key, _, fields in self.updates},
+        }
+
+
+def diff(
+        source_rows: list[dict],
+        target_rows: list[dict],
+        entity: str,
+        key: str = None,
+        delete_old: bool = False,
+        keys: set[str] = None,
+) -> SyncPlan:
+    """
+    Computes the creates, updates and deletes which make the target rows equal to the source rows.
+    :param source_rows: Raw rows of the source system
+    :param target_rows: Raw rows of the target system
+    :param entity: The entity of the rows
+    :param key: Field identifying a row in both systems, defaults to the primary id
+    :param delete_old: Flag if target rows missing in the source should be deleted
+    :param keys: Optional subset of keys to restrict the plan to
+    :return: The plan
+    """
+    plan = SyncPlan(entity, key or to_field_name(entity))
+
+    source = {row[plan.key]: comparable(row) for row in source_rows}
+    target = {row[plan.key]: row for row in target_rows}
+
+    if keys is not None:
+        source = {k: row for k, row in source.items() if k in keys}
+        target = {k: row for k, row in target.items() if k in keys}
+
+    for k in source.keys() - target.keys():
+        plan.creates.append((k, {field: value for field, value in source[k].items() if value is not None}))
+
+    for k in source.keys() & target.keys():
+        target_row = comparable(target[k])
+        changed = {
+            field: value
+            for field, value in source[k].items()
+            if field != plan.id_field and target_row.get(field) != value
+        }
+
+        if changed:
+            plan.updates.append((k, target[k][plan.id_field], changed))
+        else:
+            plan.unchanged += 1
+
+    if delete_old:
+        plan.deletes = [(k, target[k][plan.id_field]) for k in target.keys() - source.keys()]
+
+    return plan
+
+
+def apply(system, plan: SyncPlan, journal: Journal, concurrency: int = 1, progress=None) -> dict[str, int]:
+    """
+    Writes the plan to the target system in $batch requests and journals the outcome of every operation.
+    :param system: The target system
+    :param plan: The plan to apply
+    :param journal: Journal of the run
+    :param concurrency: Number of batches sent in parallel
+    :param progress: Optional gradio progress tracker
+    :return: Number of operations per journal status
+    """
+    operations = plan.operations()
+    batches = [operations[i:i + BATCH_SIZE] for i in range(0, len(operations), BATCH_SIZE)]
+
+    def send(batch):
+        return crm().batch(system, [operation for *_, operation in batch])
+
+    with ThreadPoolExecutor(max_workers=max(1, int(concurrency))) as executor:
+        results = executor.map(inherit(send), batches)
+        if progress is not None:
+            results = progress.tqdm(results, desc="Writing batches...", total=len(batches), unit="Batch")
+
+        offset = journal.offset + 1
+        for batch, statuses in zip(batches, results):
+            for (status, key, id, operation), code in zip(batch, statuses):
+                if 200 <= code < 300:
+                    journal.record(offset, key, id, status)
+                else:
+                    journal.record(offset, key, id, JournalStatus.FAILED, f"{operation[0]} returned {code}")
+                offset += 1
+
+    return journal.summary()
+
+
+def sync(
+        source_system,
+        target_system,
+        journal: Journal,
+        entity: str = CONFIGURATION_SETTINGS,
+        key: str = None,
+        delete_old: bool = False,
+        concurrency: int = 1,
+        keys: set[str] = None,
+        progress=None,
+) -> dict:
+    """
+    Synchronizes an entity from the source to the target system with two bulk reads and only the necessary writes.
+    :return: The plan and the outcome of the run
+    """
+    source_rows = crm().get_rows(source_system, entity)
+    target_rows = crm().get_rows(target_system, entity)
+
+    plan = diff(source_rows, target_rows, entity, key, delete_old, keys)
+
+    print(f"Synchronizing {entity} from {source_system} to {target_system}: {plan.to_dict()}")
+
+    return {"plan": plan.to_dict(), "result": apply(target_system, plan, journal, concurrency, progress)}
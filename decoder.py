@@ -0,0 +1,200 @@
+import json
+import re
+from typing import Callable, Iterable, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_backends: dict[str, Callable[[bytes], object]] = {"json": json.loads}
+
+if orjson is not None:
+    _backends["orjson"] = orjson.loads
+
+_backend = "orjson" if orjson is not None else "json"
+
+# A complete or unterminated string (group 1 is only set if the closing quote was read) or a structural character
+_TOKEN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*(")?|[{}\[\]]')
+# Separators followed by a complete row without nested objects or arrays, the common case of a page
+_FLAT_ROW = re.compile(rb'[\s,]*+(\{(?:[^{}\[\]"]++|"[^"\\]*+(?:\\.[^"\\]*+)*+")*+\})')
+_WHITESPACE = b" \t\r\n"
+
+
+def register_backend(name: str, loads: Callable[[bytes], object]):
+    """
+    Registers a json decoder. The function has to accept utf-8 encoded bytes.
+    :param name: Name of the backend
+    :param loads: Function decoding bytes to python objects
+    """
+    _backends[name] = loads
+
+
+def use_backend(name: str):
+    """
+    Selects the json decoder used by `loads`.
+    :param name: Name of a registered backend (e.g. 'json', 'orjson')
+    :raises KeyError: If the backend is not registered
+    """
+    global _backend
+
+    if name not in _backends:
+        raise KeyError(f"Unknown json backend {name}, available: {list(_backends)}")
+    _backend = name
+
+
+def backend() -> str:
+    return _backend
+
+
+def loads(data: bytes) -> object:
+    """
+    Decodes json straight from the response bytes with the selected backend.
+    :param data: utf-8 encoded json
+    :return: The decoded object
+    """
+    return _backends[_backend](data)
+
+
+class ValueParser:
+    """
+    Incremental parser for Web API responses of the form {..., "value": [{...}, {...}], ...}.
+
+    Chunks are fed as they arrive. Every row of the `value` array is decoded as soon as its closing
+    brace was read, so rows can be processed before the page is complete. All other top-level fields
+    (e.g. "@odata.nextLink" or "error") are collected into `envelope` once the input is closed.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.envelope: dict | None = None
+        self._buffer = bytearray()
+        self._pos = 0
+        self._depth = 0
+        self._row_start = -1
+        self._prefix: bytes | None = None
+        self._suffix_start = -1
+
+    def _is_value_key(self, token: re.Match) -> bool | None:
+        """
+        :return: If the string token is the top-level key "value", None if more input is needed to decide
+        """
+        if self._depth != 1 or token.group() != b'"value"':
+            return False
+
+        rest = bytes(self._buffer[token.end():]).lstrip(_WHITESPACE)
+        if not rest:
+            return None
+        return rest.startswith(b":")
+
+    def feed(self, chunk: bytes) -> list[dict]:
+        """
+        Adds a chunk of the response.
+        :param chunk: Next bytes of the response
+        :return: The rows completed by this chunk
+        """
+        self.size += len(chunk)
+        self._buffer += chunk
+        rows = []
+
+        if self._suffix_start >= 0:
+            return rows
+
+        while True:
+            if self._depth == 2 and self._prefix is not None:
+                row = _FLAT_ROW.match(self._buffer, self._pos)
+                if row is not None:
+                    rows.append(loads(row.group(1)))
+                    self._pos = row.end()
+                    continue
+
+            token = _TOKEN.search(self._buffer, self._pos)
+            if token is None:
+                self._pos = len(self._buffer)
+                break
+
+            char = self._buffer[token.start()]
+
+            if char == 0x22:  # "
+                if token.group(1) is None:
+                    # Unterminated string, wait for the next chunk
+                    self._pos = token.start()
+                    break
+
+                if self._prefix is None:
+                    is_value = self._is_value_key(token)
+                    if is_value is None:
+                        self._pos = token.start()
+                        break
+                    if is_value:
+                        array_start = self._buffer.find(b"[", token.end())
+                        if array_start < 0:
+                            self._pos = token.start()
+                            break
+                        self._prefix = bytes(self._buffer[:array_start])
+                        self._depth += 1
+                        self._pos = array_start + 1
+                        continue
+
+                self._pos = token.end()
+                continue
+
+            self._pos = token.end()
+
+            if char in (0x7B, 0x5B):  # { [
+                self._depth += 1
+                if self._prefix is not None and self._depth == 3 and char == 0x7B:
+                    self._row_start = token.start()
+                continue
+
+            self._depth -= 1
+
+            if self._prefix is None:
+                continue
+
+            if self._depth == 2 and char == 0x7D:  # }
+                rows.append(loads(bytes(self._buffer[self._row_start:token.end()])))
+                self._row_start = -1
+            elif self._depth == 1:
+                # End of the value array
+                self._suffix_start = self._pos
+                return rows
+
+        if self._prefix is not None:
+            # Drop the decoded rows, only the prefix is needed to build the envelope
+            cut = self._row_start if self._row_start >= 0 else self._pos
+            del self._buffer[:cut]
+            self._pos -= cut
+            if self._row_start >= 0:
+                self._row_start = 0
+
+        return rows
+
+    def close(self) -> dict:
+        """
+        Finishes the parsing after the last chunk.
+        :return: The top-level fields of the response without the rows
+        """
+        if self._prefix is None:
+            self.envelope = loads(bytes(self._buffer))
+        else:
+            suffix = bytes(self._buffer[self._suffix_start:]) if self._suffix_start >= 0 else b"}"
+            self.envelope = loads(self._prefix + b"[]" + suffix)
+
+        self._buffer = bytearray()
+        return self.envelope
+
+
+def iter_values(chunks: Iterable[bytes], parser: ValueParser = None) -> Iterator[dict]:
+    """
+    Yields the rows of the `value` array while the chunks are read.
+    The remaining fields are available in `parser.envelope` after the iteration.
+    :param chunks: Chunks of the response body, e.g. `response.iter_content(...)`
+    :param parser: Parser to use, pass one to access the envelope afterwards
+    """
+    parser = parser or ValueParser()
+
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+
+    parser.close()
@@ -3,8 +3,9 @@ import sys
 import gradio as gr
 
 import main
+from metadata import metadata
 from misc import get_enum_values, Activity, Ignore, to_field_name
-from msal_app import crm
+from profiler import profiler, ProfileMode, TOP_N
 
 
 def on_entity_change():
@@ -21,13 +22,11 @@ def get_entities(system) -> list[str]:
 
     local_ignore = [*get_enum_values(Activity), *get_enum_values(Ignore)]
 
-    entities_json = crm().get(system, "entities", "select=entitysetname", False)
     entities = [
-        entity.payload["entitysetname"]
-        for entity in entities_json
-        if entity.payload["entitysetname"] not in local_ignore
+        entity
+        for entity in metadata().entities(system)
+        if entity not in local_ignore
     ]
-    entities.sort()
 
     return entities
 
@@ -36,6 +35,12 @@ def on_system_change(system):
     return gr.update(choices=get_entities(system))
 
 
+def on_refresh_metadata(system):
+    metadata().refresh(system)
+    gr.Info(f"Metadata of {system} refreshed")
+    return gr.update(choices=get_entities(system))
+
+
 def on_system_change_solutions(system):
     return gr.update(choices=main.get_solutions_from_system(system))
 
@@ -44,13 +49,8 @@ def on_relation_settings_change(system, choice, entity_name: str):
     if choice == 1:
         return gr.update(
             choices=[
-                data.payload["name"].split("_", 1)[1]
-                for data in crm().get(
-                    system,
-                    "relationships",
-                    f"select=name&$filter=(startswith(name, '{to_field_name(entity_name)[:-2]}'))",
-                    False,
-                )
+                name.split("_", 1)[1]
+                for name in metadata().relationships(system, to_field_name(entity_name)[:-2])
             ],
             interactive=True,
         )
@@ -58,6 +58,28 @@ def on_relation_settings_change(system, choice, entity_name: str):
         return gr.update(interactive=False)
 
 
+def on_profiling_change(enabled, mode):
+    profiler().configure(enabled, ProfileMode(mode))
+
+
+def on_refresh_profiles():
+    labels = [result.label for result in profiler().results]
+    return gr.update(choices=labels, value=labels[0] if labels else None)
+
+
+def on_profile_select(label, top_n):
+    result = profiler().find(label)
+
+    if result is None:
+        return gr.update(value=None), gr.update(value=None)
+
+    files = [result.folded_path] + ([result.stats_path] if result.stats_path else [])
+    return (
+        gr.update(value={"headers": result.headers, "data": result.top(int(top_n))}),
+        gr.update(value=files),
+    )
+
+
 class GradioApp:
     def __init__(self, config):
         config = dict(config.items("Options"))
@@ -66,6 +88,7 @@ class GradioApp:
         tar_system = config["defaulttargetenvironment"]
         src_system = config["defaultsourceenvironment"]
         path_to_solution = config["pathtomainsolution"]
+        retry_concurrency = int(config.get("retryconcurrency", 4))
 
         with gr.Blocks(theme=gr.themes.Soft()) as demo:
             source_system = gr.Dropdown(
@@ -73,6 +96,9 @@ class GradioApp:
                 choices=systems,
                 value=src_system,
             )
+            refresh_metadata_button = gr.Button("Refresh metadata", size="sm")
+
+            metadata().warm(systems)
 
             # Tab 0
             # Export Solution
@@ -90,13 +116,19 @@ class GradioApp:
                     interactive=True,
                 )
 
+                use_cached_export = gr.Checkbox(
+                    label="Use cached export",
+                    info="Reuse the stored export if the solution version did not change",
+                    value=False,
+                )
+
                 export_button = gr.Button("Export Solution")
 
                 solution = gr.File(label="Solution Zip File", interactive=False)
 
                 export_button.click(
                     main.export_solution,
-                    inputs=[solution_to_export, main_solution_path, source_system],
+                    inputs=[solution_to_export, main_solution_path, source_system, use_cached_export],
                     outputs=solution,
                 )
 
@@ -111,7 +143,7 @@ class GradioApp:
 
             with gr.Tab("Transfer Solution"):
                 system_to_transfer_solution = gr.Dropdown(
-                    choices=systems, label="Target System", value=tar_system
+                    choices=systems, label="Target Systems", value=[tar_system], multiselect=True
                 )
 
                 solution_to_transfer = gr.Dropdown(
@@ -122,6 +154,12 @@ class GradioApp:
                 )
 
                 publish = gr.Checkbox(label="Publish customizations after transfer", value=True)
+                use_cached_transfer = gr.Checkbox(
+                    label="Use cached export",
+                    info="Reuse the stored export if the solution version did not change. "
+                         "Unmanaged solutions can change without a new version",
+                    value=False,
+                )
 
                 transfer_button = gr.Button("Transfer Solution")
 
@@ -129,7 +167,7 @@ class GradioApp:
 
                 transfer_button.click(main.transfer_solution,
                                       inputs=[source_system, system_to_transfer_solution, solution_to_transfer,
-                                              publish], outputs=transfer_output)
+                                              publish, use_cached_transfer], outputs=transfer_output)
 
                 source_system.change(
                     on_system_change_solutions,
@@ -176,7 +214,19 @@ class GradioApp:
                         info="All relations regarding this entity",
                         interactive=False,
                     )
-                send_button = gr.Button("Submit")
+                with gr.Row():
+                    resume = gr.Checkbox(label="Resume from last checkpoint", value=True)
+                    concurrency = gr.Slider(
+                        label="Retry concurrency",
+                        minimum=1,
+                        maximum=16,
+                        step=1,
+                        value=retry_concurrency,
+                    )
+                with gr.Row():
+                    send_button = gr.Button("Submit")
+                    dry_run_button = gr.Button("Dry run")
+                    retry_button = gr.Button("Retry failed records")
                 with gr.Row():
                     web_api_output = gr.Json(label="JSON Data")
 
@@ -189,6 +239,8 @@ class GradioApp:
 
             source_system.change(on_system_change, inputs=source_system, outputs=entity)
 
+            refresh_metadata_button.click(on_refresh_metadata, inputs=source_system, outputs=entity)
+
             send_button.click(
                 main.transfer_data,
                 inputs=[
@@ -198,16 +250,70 @@ class GradioApp:
                     entity,
                     include_relations,
                     relation_dropdown,
+                    resume,
                 ],
                 outputs=[web_api_output],
             )
 
+            dry_run_button.click(
+                main.dry_run_transfer,
+                inputs=[source_system, target_system, api_filter, entity],
+                outputs=[web_api_output],
+            )
+
+            retry_button.click(
+                main.retry_transfer_data,
+                inputs=[source_system, target_system, api_filter, entity, concurrency],
+                outputs=[web_api_output],
+            )
+
             entity.change(
                 on_entity_change,
                 inputs=None,
                 outputs=[relation_dropdown, include_relations],
             )
 
+            # Tab 1.75
+            # Transfer multiple entities using Web API
+
+            with gr.Tab("Transfer multiple entities"):
+                target_system_multi = gr.Dropdown(
+                    label="Target system",
+                    choices=systems,
+                    value=tar_system,
+                    interactive=True,
+                )
+
+                entities_and_filters = gr.Dataframe(
+                    headers=["Entity", "Filter"],
+                    datatype=["str", "str"],
+                    col_count=(2, "fixed"),
+                    row_count=4,
+                    type="array",
+                    label="Entities and filters",
+                    interactive=True,
+                )
+
+                with gr.Row():
+                    resume_multi = gr.Checkbox(label="Resume from last checkpoint", value=True)
+                    concurrency_multi = gr.Slider(
+                        label="Parallel entities",
+                        minimum=1,
+                        maximum=16,
+                        step=1,
+                        value=retry_concurrency,
+                    )
+
+                multi_button = gr.Button("Transfer entities")
+                multi_output = gr.Json(label="Throughput")
+
+            # Listeners
+            multi_button.click(
+                main.transfer_multiple_entities,
+                inputs=[source_system, target_system_multi, entities_and_filters, concurrency_multi, resume_multi],
+                outputs=[multi_output],
+            )
+
             # Tab 2
             # Transfer configuration settings
 
@@ -220,14 +326,29 @@ class GradioApp:
                 )
 
                 dov = gr.Checkbox(label="Delete old values")
+                concurrency_tcs = gr.Slider(
+                    label="Parallel batches",
+                    minimum=1,
+                    maximum=16,
+                    step=1,
+                    value=retry_concurrency,
+                )
 
-                tcs_button = gr.Button("Transfer settings...")
+                with gr.Row():
+                    tcs_button = gr.Button("Transfer settings...")
+                    tcs_retry_button = gr.Button("Retry failed settings")
                 tcs_output = gr.Textbox(label="Output data")
 
             # Listeners
             tcs_button.click(
                 main.transfer_configuration_settings,
-                inputs=[source_system, target_system_tcs, dov],
+                inputs=[source_system, target_system_tcs, dov, concurrency_tcs],
+                outputs=[tcs_output],
+            )
+
+            tcs_retry_button.click(
+                main.retry_configuration_settings,
+                inputs=[source_system, target_system_tcs, dov, concurrency_tcs],
                 outputs=[tcs_output],
             )
 
@@ -253,6 +374,39 @@ class GradioApp:
                 main.debug, inputs=[db_choice, db_payload], outputs=[db_output]
             )
 
+            # Tab 3.5
+            # Performance
+
+            with gr.Tab("Performance"):
+                with gr.Row():
+                    profiling_enabled = gr.Checkbox(
+                        label="Profile runs",
+                        info="Profiles transfers, configuration settings and solution exports",
+                        value=False,
+                    )
+                    profiling_mode = gr.Radio(
+                        choices=[mode.value for mode in ProfileMode],
+                        label="Mode",
+                        value=ProfileMode.SAMPLING.value,
+                    )
+                with gr.Row():
+                    profile_run = gr.Dropdown(label="Profiled run", interactive=True)
+                    profile_top_n = gr.Slider(label="Top functions", minimum=5, maximum=100, step=5, value=TOP_N)
+                    profile_refresh = gr.Button("Refresh runs")
+                profile_table = gr.Dataframe(label="Hot functions", interactive=False)
+                profile_files = gr.File(label="Profile files (folded stacks for flamegraphs)", file_count="multiple")
+
+            # Listeners
+            profiling_enabled.change(on_profiling_change, inputs=[profiling_enabled, profiling_mode])
+            profiling_mode.change(on_profiling_change, inputs=[profiling_enabled, profiling_mode])
+            profile_refresh.click(on_refresh_profiles, outputs=profile_run)
+            profile_run.change(
+                on_profile_select, inputs=[profile_run, profile_top_n], outputs=[profile_table, profile_files]
+            )
+            profile_top_n.change(
+                on_profile_select, inputs=[profile_run, profile_top_n], outputs=[profile_table, profile_files]
+            )
+
             # Tab 4
             # Configuration
 
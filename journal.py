@@ -0,0 +1,198 @@
+import json
+import os
+import threading
+from datetime import datetime
+from enum import Enum
+from hashlib import sha1
+
+from logger import logger, LoggerLevel
+
+JOURNAL_PATH = "./journals"
+
+
+class JournalStatus(Enum):
+    CREATED = "created"
+    UPDATED = "updated"
+    DELETED = "deleted"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+
+
+class JournalEntry:
+
+    def __init__(
+            self,
+            offset: int,
+            source_id: str,
+            target_id: str | None,
+            status: JournalStatus,
+            message: str | None = None,
+            timestamp: str | None = None,
+    ):
+        self.offset = offset
+        self.source_id = source_id
+        self.target_id = target_id
+        self.status = status
+        self.message = message
+        self.timestamp = timestamp or datetime.now().isoformat()
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "offset": self.offset,
+                "source_id": self.source_id,
+                "target_id": self.target_id,
+                "status": self.status.value,
+                "message": self.message,
+                "timestamp": self.timestamp,
+            }
+        )
+
+    @classmethod
+    def from_json(cls, line: str) -> "JournalEntry":
+        data = json.loads(line)
+        return cls(
+            data["offset"],
+            data["source_id"],
+            data["target_id"],
+            JournalStatus(data["status"]),
+            data.get("message"),
+            data.get("timestamp"),
+        )
+
+
+class Journal:
+    """
+    Append-only checkpoint journal of a transfer run.
+
+    Every processed source record is written as one json line containing its offset in the
+    source result, the id in the target system and the status. Lines are flushed to disk
+    immediately, so a run that dies can be resumed by skipping the source ids already journaled
+    and the failed subset can be retried on its own. Offsets are only informational, the order of
+    a Web API result is not stable between runs.
+    """
+
+    def __init__(self, run_id: str, resume: bool = True, path: str = JOURNAL_PATH):
+        """
+        Opens the journal of a run and replays the existing entries.
+        :param run_id: Identifier of the run, see `transfer_run_id`
+        :param resume: Flag if existing entries should be kept. Otherwise, the old journal is archived
+        :param path: Directory the journals are stored in
+        """
+        os.makedirs(path, exist_ok=True)
+
+        self.run_id = run_id
+        self.path = os.path.join(path, f"{run_id}.jsonl")
+        self.entries: dict[str, JournalEntry] = {}
+        self._committed: set[int] = set()
+        self.offset = -1
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            if resume:
+                self._replay()
+            else:
+                archived = f"{self.path[:-6]}_{datetime.now().strftime('%d.%m.%Y_%H-%M-%S')}.jsonl"
+                os.replace(self.path, archived)
+                logger().log(f"Archived journal {self.path} to {archived}")
+
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _replay(self):
+        for entry in _read_entries(self.path):
+            self._apply(entry)
+
+        logger().log(f"Replayed {len(self.entries)} journal entries of run {self.run_id}, offset {self.offset}")
+
+    def _apply(self, entry: JournalEntry):
+        self.entries[entry.source_id] = entry
+        self._committed.add(entry.offset)
+
+        while self.offset + 1 in self._committed:
+            self.offset += 1
+
+    def record(
+            self,
+            offset: int,
+            source_id: str,
+            target_id: str | None,
+            status: JournalStatus,
+            message: str | None = None,
+    ) -> JournalEntry:
+        """
+        Appends an entry to the journal and flushes it to disk.
+        :param offset: Position of the record in the source result
+        :param source_id: Id of the record in the source system
+        :param target_id: Id of the record in the target system, if known
+        :param status: Outcome of the record
+        :param message: Optional error message
+        :return: The written entry
+        """
+        entry = JournalEntry(offset, source_id, target_id, status, message)
+
+        with self._lock:
+            self._file.write(entry.to_json() + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._apply(entry)
+
+        return entry
+
+    def is_done(self, source_id: str) -> bool:
+        entry = self.entries.get(source_id)
+        return entry is not None and entry.status != JournalStatus.FAILED
+
+    def failed(self) -> list[JournalEntry]:
+        return [entry for entry in self.entries.values() if entry.status == JournalStatus.FAILED]
+
+    def summary(self) -> dict[str, int]:
+        summary = {status.value: 0 for status in JournalStatus}
+        for entry in self.entries.values():
+            summary[entry.status.value] += 1
+        return summary
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _read_entries(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield JournalEntry.from_json(line)
+            except (ValueError, KeyError):
+                # A partially written last line is the only expected corruption
+                logger().log(f"Skipping corrupt journal line in {path}: {line!r}", LoggerLevel.WARNING)
+
+
+def read_journal(run_id: str, path: str = JOURNAL_PATH) -> dict[str, JournalEntry]:
+    """
+    Reads the latest entry per source id of a run without opening the journal for writing.
+    :param run_id: Identifier of the run, see `transfer_run_id`
+    :param path: Directory the journals are stored in
+    :return: Entries by source id, empty if the run has no journal
+    """
+    file = os.path.join(path, f"{run_id}.jsonl")
+
+    if not os.path.exists(file):
+        return {}
+
+    return {entry.source_id: entry for entry in _read_entries(file)}
+
+
+def transfer_run_id(*parts) -> str:
+    """
+    Builds a stable run id from the parameters of a transfer, so that a rerun with the same
+    parameters continues the journal of the previous run.
+    :param parts: Parameters identifying the run (e.g. systems, entity, filter)
+    :return: The run id
+    """
+    digest = sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:12]
+    return f"{parts[0]}_{digest}" if parts else digest
@@ -1,18 +1,36 @@
 import json
+import shutil
 import subprocess
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from configparser import ConfigParser
 import os
 
 from gradio import update, Progress, Info
+from requests import RequestException
+
+from artifacts import artifacts
+from config_sync import CONFIGURATION_SETTINGS, sync
+from decoder import loads
+from journal import Journal, JournalStatus, transfer_run_id
+from misc import to_field_name, response_is_error
 from msal_app import crm
+from pipeline import BoundedPipeline
+from planner import plan_transfer
+from profiler import profiled
 from record import (
     known_records,
     loaded_records,
     Record,
-    filter_existing_records,
+    get_record,
     Reference,
+    ReferenceResolver,
 )
 
+OUTPUT_PREVIEW = 100
+
 
 def save_settings(*settings):
     for setting in settings:
@@ -21,50 +39,90 @@ def save_settings(*settings):
     Info("Settings Successfully Saved")
 
 
-def transfer_solution(
-        system, target_system, solution_name, publish, progress=Progress()
-):
-    export_solution(solution_name, "", system, progress)
-    progress(.5, desc="Importing Solution...")
-    # Update Progress description
+def import_solution(solution_path, target_system, publish) -> str:
     command = (
-            f"pac solution import --path ./solutions/{solution_name}.zip --environment https://{target_system}.crm4.dynamics.com/ --activate-plugins"
+            f"pac solution import --path {solution_path} --environment https://{target_system}.crm4.dynamics.com/ --activate-plugins"
             + (" --publish-changes" if publish else "")
     )
+    print(command)
 
     process = subprocess.run(
         command, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
     )
 
-    if process.returncode == 0:
-        return update(value=process.stdout.decode())
+    return process.stdout.decode()
 
 
-def traverse_record(record: Record, target_system, already_traversed=None):
+def transfer_solution(
+        system, target_systems, solution_name, publish, use_cache: bool = False, progress=Progress()
+):
+    if isinstance(target_systems, str):
+        target_systems = [target_systems]
+
+    solution_path, export_folder = export_artifact(solution_name, system, use_cache=use_cache, progress=progress)
+
+    progress(.5, desc=f"Importing Solution into {', '.join(target_systems)}...")
+
+    try:
+        # One export is imported into all targets at once
+        with ThreadPoolExecutor(max_workers=max(1, len(target_systems))) as executor:
+            futures = {
+                target_system: executor.submit(import_solution, solution_path, target_system, publish)
+                for target_system in target_systems
+            }
+            outputs = []
+            # A failing import must not hide the outcome of the other targets
+            for target_system, future in futures.items():
+                try:
+                    outputs.append(f"### {target_system}\n{future.result()}")
+                except subprocess.CalledProcessError as e:
+                    print(f"Import of {solution_name} into {target_system} failed: {e}")
+                    outputs.append(f"### {target_system} (failed)\n{e.stdout.decode()}{e.stderr.decode()}")
+    finally:
+        if export_folder is not None:
+            shutil.rmtree(export_folder, ignore_errors=True)
+
+    return update(value="\n".join(outputs))
+
+
+def traverse_record(
+        record: Record,
+        target_system,
+        already_traversed=None,
+        resolver: ReferenceResolver = None,
+        apply: bool = True,
+):
+    """
+    Binds the references of a record to existing records or nests the referenced payloads to insert them with it.
+    :param already_traversed: Collects the ids of every record whose payload is changed
+    :param apply: Flag if the payloads should be changed, otherwise only `already_traversed` is collected
+    """
     if already_traversed is None:
         already_traversed = []
 
     def traverse_reference(record: Record, reference: Reference, already_traversed):
-        ref_rec = reference.get_record()
+        ref_rec = resolver.get_record(reference) if resolver else reference.get_record()
 
         # Remove the team reference because a team can not be existing in target environment
         if ref_rec.entity == "teams":
             print(ref_rec.payload, ref_rec.original_payload)
-            traverse_record(ref_rec, target_system, already_traversed)
+            traverse_record(ref_rec, target_system, already_traversed, resolver, apply)
 
         if (
                 reference.id in already_traversed
-                or ref_rec.already_exists(target_system)
+                or (resolver.exists(ref_rec) if resolver else ref_rec.already_exists(target_system))
                 or ref_rec.entity == "systemusers"
         ):
-            record.payload[
-                reference.key + "@odata.bind"
-                ] = f"/{reference.entity}({ref_rec.id})"
+            if apply:
+                record.payload[
+                    reference.key + "@odata.bind"
+                    ] = f"/{reference.entity}({ref_rec.id})"
             return
 
-        record.payload[reference.key] = ref_rec.payload
+        if apply:
+            record.payload[reference.key] = ref_rec.payload
 
-        traverse_record(ref_rec, target_system, already_traversed)
+        traverse_record(ref_rec, target_system, already_traversed, resolver, apply)
 
     if record.id in already_traversed:
         return
@@ -75,6 +133,140 @@ def traverse_record(record: Record, target_system, already_traversed=None):
         traverse_reference(record, ref, already_traversed)
 
 
+def prepare_record(
+        journal: Journal,
+        offset: int,
+        record: Record,
+        target_system,
+        traverse: bool = True,
+        resolver: ReferenceResolver = None,
+) -> bool:
+    """
+    Checks if a record has to be posted and traverses its references.
+    :param journal: Journal of the current run
+    :param offset: Position of the record in the source result
+    :param record: The record to transfer
+    :param target_system: The system to transfer the record to
+    :param traverse: Flag if the references of the record should be traversed
+    :param resolver: Optional resolver sharing reference lookups with other transfers of the run
+    :return: False if the record already exists in the target system
+    """
+    if resolver.exists(record) if resolver else record.already_exists(target_system):
+        print(
+            f"{record.entity} with id {record.id} already exists in {target_system}, skipping..."
+        )
+        journal.record(offset, record.id, record.id, JournalStatus.SKIPPED)
+        return False
+
+    if traverse:
+        traverse_record(record, target_system, resolver=resolver)
+
+        print(
+            f"Traversed {record.entity} with id {record.id}. Attempting to post to {target_system}..."
+        )
+
+    return True
+
+
+def error_message(response) -> str:
+    """
+    Returns the error of a failed response, also if the body is no json (e.g. the html page of a gateway).
+    """
+    try:
+        return json.dumps(response_is_error(response))
+    except (ValueError, TypeError):
+        return f"{response.status_code} {response.reason}: {response.text[:500]}"
+
+
+def send_record(
+        journal: Journal,
+        offset: int,
+        record: Record,
+        target_system,
+        resolver: ReferenceResolver = None,
+) -> dict | None:
+    """
+    Posts a prepared record to the target system and writes the outcome to the journal.
+    :return: The posted payload or None if the post failed
+    """
+    obj = record.payload
+
+    try:
+        post = crm().post(target_system, record.entity, obj)
+    except RequestException as e:
+        journal.record(offset, record.id, None, JournalStatus.FAILED, str(e))
+        return None
+
+    if not post.ok:
+        journal.record(offset, record.id, None, JournalStatus.FAILED, error_message(post))
+        return None
+
+    try:
+        message_json = loads(post.content) if post.content else {}
+    except ValueError as e:
+        journal.record(offset, record.id, None, JournalStatus.FAILED, f"Invalid response body: {e}")
+        return None
+    print(message_json)
+
+    if resolver:
+        resolver.mark_posted(record)
+
+    journal.record(
+        offset,
+        record.id,
+        message_json.get(to_field_name(record.entity), record.id),
+        JournalStatus.CREATED,
+    )
+    return obj
+
+
+def post_record(
+        journal: Journal,
+        offset: int,
+        record: Record,
+        target_system,
+        traverse: bool = True,
+        resolver: ReferenceResolver = None,
+) -> dict | None:
+    """
+    Transfers a single record to the target system and writes the outcome to the journal.
+    See `prepare_record` and `send_record`.
+
+    With a resolver, the record and every reference it would insert are claimed first, so transfers
+    running in parallel never insert the same record twice or change the same payload. A transfer
+    finding a record claimed by another waits for it and binds to the record if it was posted.
+    :return: The posted payload or None if nothing was posted
+    """
+    if resolver is None:
+        if not prepare_record(journal, offset, record, target_system, traverse):
+            return None
+
+        return send_record(journal, offset, record, target_system)
+
+    while True:
+        if not prepare_record(journal, offset, record, target_system, False, resolver):
+            return None
+
+        # The traversal collects the record itself and every record it would insert or change
+        claimed = []
+        if traverse:
+            traverse_record(record, target_system, claimed, resolver, apply=False)
+        else:
+            claimed.append(record.id)
+
+        if resolver.claim(claimed):
+            break
+
+    try:
+        if traverse:
+            traverse_record(record, target_system, resolver=resolver)
+
+        return send_record(journal, offset, record, target_system, resolver)
+    finally:
+        resolver.release(claimed)
+
+
+@profiled()
 def transfer_data(
         source_system,
         target_system,
@@ -82,46 +274,40 @@ def transfer_data(
         entity: str,
         include_relations: int,
         dropdown,
+        resume: bool = True,
         progress=Progress(),
 ):
-    output = []
-
     print("Starting Transfer...")
+    print(f"Executing transfer with {len(known_records)} records in cache")
 
-    records = crm().get(source_system, entity, filter)
-
-    print(f"Executing transfer with {len(known_records.values())} records in cache")
-
-    obj = {"message": "No Data was transferred"}
+    pipeline = BoundedPipeline(known_records)
+    # Only the latest payloads are kept for the output, the journal has every record
+    output = deque(maxlen=OUTPUT_PREVIEW)
+    posted = 0
 
-    for record in progress.tqdm(records, desc="Posting records...", unit="Record"):
-        if record.already_exists(target_system):
-            print(
-                f"{record.entity} with id {record.id} already exists in {target_system}, skipping..."
-            )
-            continue
+    with Journal(transfer_run_id(entity, source_system, target_system, filter), resume) as journal:
+        if journal.entries:
+            print(f"Resuming run {journal.run_id}, skipping {len(journal.entries)} journaled records")
 
-        traverse_record(record, target_system)
+        def transform(item):
+            offset, record = item
+            # The Web API result has no stable order, so resume by source id rather than by offset
+            return None if journal.is_done(record.id) else item
 
-        obj = record.payload
+        def sink(item):
+            nonlocal posted
+            # Existence checks and traversal run right before the post, so they see every record inserted so far
+            obj = post_record(journal, *item, target_system)
 
-        print(
-            f"Traversed {record.entity} with id {record.id}. Attempting to post to {target_system}..."
-        )
+            if obj is not None:
+                output.append(obj)
+                posted += 1
+            progress((item[0] + 1, None), desc="Posting records...", unit="Record")
 
-        while True:
-            post = crm().post(
-                target_system,
-                entity,
-                obj,
-            )
+        pipeline.run(enumerate(crm().iter_records(source_system, entity, filter)), transform, sink)
 
-            # TODO ERROR HANDLING
-            # Check message and fix the error
-            message_json = post.json()
-            print(message_json)
-            output.append(obj)
-            break
+        summary = journal.summary()
+        print(f"Finished run {journal.run_id}: {summary}")
 
     known_records.update(loaded_records)
 
@@ -129,90 +315,420 @@ def transfer_data(
     #    print("Opened cache and saving dictionary")
     #    pickle.dump(known_records, f)
 
+    report = pipeline.report()
+    print(f"Pipeline: {report}")
+
+    return update(
+        value=json.dumps(
+            {"posted": posted, "summary": summary, "pipeline": report, "latest": list(output)}, indent=4
+        )
+    )
+
+
+def dry_run_transfer(source_system, target_system, filter: str, entity: str, progress=Progress()):
+    progress(0, desc="Planning transfer...")
+
+    plan = plan_transfer(source_system, target_system, entity, filter)
+
+    print(f"Planned transfer of {entity}: {len(plan.create)} to create, {len(plan.skip)} existing")
+
+    return update(value=json.dumps(plan.to_dict(), indent=4))
+
+
+def retry_failed_records(
+        journal: Journal,
+        source_system,
+        target_system,
+        entity: str,
+        concurrency: int,
+        progress: Progress,
+        traverse: bool = True,
+) -> list[dict]:
+    """
+    Retries only the records which failed in a previous run of the journal.
+    :param journal: Journal of the run to retry
+    :param source_system: The system the records are read from
+    :param target_system: The system the records are posted to
+    :param entity: The entity of the records
+    :param concurrency: Number of records posted in parallel
+    :param progress: Gradio progress tracker
+    :param traverse: Flag if the references of the records should be traversed before posting
+    :return: The posted payloads
+    """
+    failed = journal.failed()
+    resolver = ReferenceResolver(target_system)
+
+    def retry(entry):
+        record = get_record(source_system, entity, entry.source_id)
+
+        if record is None:
+            journal.record(
+                entry.offset, entry.source_id, None, JournalStatus.FAILED, "Record not found in source system"
+            )
+            return None
+
+        return post_record(journal, entry.offset, record, target_system, traverse, resolver)
+
+    print(f"Retrying {len(failed)} failed records of run {journal.run_id} with concurrency {concurrency}")
+
+    with ThreadPoolExecutor(max_workers=max(1, int(concurrency))) as executor:
+        results = list(
+            progress.tqdm(
+                executor.map(retry, failed), desc="Retrying failed records...", total=len(failed), unit="Record"
+            )
+        )
+
+    print(f"Finished retry of run {journal.run_id}: {journal.summary()}")
+
+    return [result for result in results if result is not None]
+
+
+def retry_transfer_data(
+        source_system, target_system, filter: str, entity: str, concurrency, progress=Progress()
+):
+    with Journal(transfer_run_id(entity, source_system, target_system, filter)) as journal:
+        output = retry_failed_records(journal, source_system, target_system, entity, concurrency, progress)
+
     return update(value=json.dumps(output, indent=4))
 
 
-def get_solutions_from_system(system):
+def _strongly_connected(dependencies: dict[str, set[str]]) -> list[list[str]]:
+    """
+    Splits a dependency graph into its strongly connected components (Tarjan).
+    :param dependencies: Dependencies by node
+    :return: Components with their nodes in the given order
+    """
+    order = {node: i for i, node in enumerate(dependencies)}
+    index: dict[str, int] = {}
+    low: dict[str, int] = {}
+    stack: list[str] = []
+    on_stack: set[str] = set()
+    components = []
+
+    def visit(node):
+        index[node] = low[node] = len(index)
+        stack.append(node)
+        on_stack.add(node)
+
+        for dep in dependencies[node]:
+            if dep not in index:
+                visit(dep)
+                low[node] = min(low[node], low[dep])
+            elif dep in on_stack:
+                low[node] = min(low[node], index[dep])
+
+        if low[node] == index[node]:
+            component = []
+            while True:
+                member = stack.pop()
+                on_stack.discard(member)
+                component.append(member)
+                if member == node:
+                    break
+            components.append(sorted(component, key=order.get))
+
+    for node in dependencies:
+        if node not in index:
+            visit(node)
+
+    return components
+
+
+def order_entities(records_by_entity: dict[str, list[Record]]) -> list[list[str]]:
+    """
+    Orders entities by the lookups of their records. An entity is placed after every selected entity
+    it references, entities in the same level do not depend on each other and can run in parallel.
+    Only entities referencing each other in a cycle run one after another, in the given order.
+    :param records_by_entity: Fetched records of every selected entity
+    :return: List of levels, each a list of entity names
+    """
+    dependencies = {
+        entity: {
+            reference.entity
+            for record in records
+            for reference in record.references.values()
+            if reference.entity in records_by_entity and reference.entity != entity
+        }
+        for entity, records in records_by_entity.items()
+    }
+
+    # Entities referencing each other in a cycle are collapsed into one component, the components form a DAG
+    components = _strongly_connected(dependencies)
+    component_of = {entity: i for i, component in enumerate(components) for entity in component}
+    component_dependencies = {
+        i: {component_of[dep] for entity in component for dep in dependencies[entity]} - {i}
+        for i, component in enumerate(components)
+    }
+
+    levels = []
+    remaining = dict(component_dependencies)
+
+    while remaining:
+        level = [i for i, deps in remaining.items() if not deps & remaining.keys()]
+
+        for i in level:
+            if len(components[i]) > 1:
+                print(f"Cyclic lookups between {components[i]}, transferring them sequentially")
+
+        # The entities of a cycle run one after another, independent components run in parallel
+        for step in range(max(len(components[i]) for i in level)):
+            levels.append([components[i][step] for i in level if step < len(components[i])])
+
+        for i in level:
+            remaining.pop(i)
+
+    return levels
+
+
+def transfer_multiple_entities(
+        source_system,
+        target_system,
+        entities_and_filters: list[list[str]],
+        concurrency,
+        resume: bool = True,
+        progress=Progress(),
+):
+    """
+    Transfers several entities in one run. The order is derived from the lookups between the entities,
+    independent entities are transferred in parallel and shared references are resolved only once.
+    :param source_system: The system the records are read from
+    :param target_system: The system the records are posted to
+    :param entities_and_filters: Rows of entity name and filter
+    :param concurrency: Maximum number of entities transferred in parallel
+    :param resume: Flag if the journals of previous runs should be continued
+    :param progress: Gradio progress tracker
+    :return: Throughput report per entity
+    """
+    selection = {
+        row[0].strip(): (row[1].strip() if len(row) > 1 and row[1] else None)
+        for row in entities_and_filters
+        if row and row[0] and row[0].strip()
+    }
+
+    if not selection:
+        return update(value=json.dumps({"message": "No entities selected"}, indent=4))
+
+    workers = max(1, int(concurrency))
+    resolver = ReferenceResolver(target_system)
+
+    progress(0, desc="Fetching records...")
+
+    def fetch(entity, filter) -> list[Record]:
+        return list(crm().iter_records(source_system, entity, filter))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {entity: executor.submit(fetch, entity, filter) for entity, filter in selection.items()}
+        records_by_entity = {entity: future.result() for entity, future in futures.items()}
+
+    levels = order_entities(records_by_entity)
+    print(f"Transferring entities in order {levels}")
+
+    def transfer_entity(entity):
+        records = records_by_entity[entity]
+        start = time.perf_counter()
+
+        with Journal(
+                transfer_run_id(entity, source_system, target_system, selection[entity]), resume
+        ) as journal:
+            for offset, record in enumerate(records):
+                if journal.is_done(record.id):
+                    continue
+
+                post_record(journal, offset, record, target_system, resolver=resolver)
+
+            summary = journal.summary()
+
+        seconds = time.perf_counter() - start
+        return {
+            "entity": entity,
+            "records": len(records),
+            **summary,
+            "seconds": round(seconds, 2),
+            "records_per_second": round(len(records) / seconds, 2) if seconds else None,
+        }
+
+    report = []
+    done = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for level in levels:
+            futures = [executor.submit(transfer_entity, entity) for entity in level]
+
+            for future in as_completed(futures):
+                report.append(future.result())
+                done += 1
+                progress(done / len(selection), desc=f"Transferred {report[-1]['entity']}")
+
+    known_records.update(loaded_records)
+
+    for entry in report:
+        print(
+            f"{entry['entity']}: {entry['records']} records in {entry['seconds']}s "
+            f"({entry['records_per_second']} records/s)"
+        )
+
+    return update(value=json.dumps({"order": levels, "throughput": report}, indent=4))
+
+
+def list_solutions(system) -> list[tuple[str, str, bool]] | None:
+    """
+    Lists the solutions of a system with the power platform cli.
+    :param system: Systemname (e.g. 'myxrm-dev01')
+    :return: Tuples of unique name, version and managed flag or None if the solutions could not be loaded
+    """
     command = f"pac solution list --environment https://{system}.crm4.dynamics.com/"
     print(command)
     process = subprocess.run(
         command, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
     )
 
-    if process.returncode == 0:
-        output = process.stdout.decode()
-        lines = output.split("\n")[5:-2]
+    if process.returncode != 0:
+        return None
+
+    output = process.stdout.decode()
+    lines = output.split("\n")[5:-2]
+
+    solutions = []
+    for line in lines:
+        split = line.split()
+        solutions.append((split[0], split[-2], split[-1] == "True"))
+
+    return solutions
 
-        unique_names = []
-        for line in lines:
-            split = line.split()
-            name = split[0]
-            managed = split[-1] == "True"
 
-            if not managed:
-                unique_names.append(name)
+def get_solutions_from_system(system):
+    solutions = list_solutions(system)
 
-        return unique_names
+    if solutions is not None:
+        return [name for name, _, managed in solutions if not managed]
 
     return ["Could not load solutions"]
 
 
-def export_solution(solution_name, export_path, environment, progress=Progress()):
+def export_artifact(
+        solution_name, environment, managed: bool = False, use_cache: bool = True, progress=Progress()
+) -> tuple[str, str | None]:
+    """
+    Exports a solution into the artifact store, or reuses the stored export of the same version.
+    :param solution_name: Unique name of the solution
+    :param environment: The system to export from
+    :param managed: Flag if the solution should be exported as managed
+    :param use_cache: Flag if a stored export of the current version may be reused
+    :param progress: Gradio progress tracker
+    :return: Path of the exported zip and the folder the caller has to remove after using it,
+        None if the zip is kept in the artifact store
+    """
+    versions = {name: version for name, version, _ in list_solutions(environment) or []}
+    version = versions.get(solution_name)
+
+    if version is None:
+        # Without a version the export can not be told apart from older ones, so it is never cached
+        print(f"Version of {solution_name} in {environment} is unknown, the export is not cached")
+    elif use_cache:
+        cached = artifacts().get(environment, solution_name, version, managed)
+        if cached is not None:
+            print(f"Reusing export of {solution_name} {version} from {environment}: {cached}")
+            return cached, None
+
     progress(0, desc="Exporting Solution...")
 
-    solution_path = f'./solutions/{solution_name}.zip'
+    export_folder = os.path.join("./solutions", "exports", uuid.uuid4().hex)
+    os.makedirs(export_folder)
 
-    command = f"pac solution export --name {solution_name} --path ./solutions --environment https://{environment}.crm4.dynamics.com/"
-    print(command)
-    process = subprocess.run(
-        command, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    command = (
+            f"pac solution export --name {solution_name} --path {export_folder} --environment https://{environment}.crm4.dynamics.com/"
+            + (" --managed" if managed else "")
     )
+    print(command)
 
-    if process.returncode == 0:
-        print(
-            f"Solution {solution_name} exported successfully to {os.path.abspath(f'./solutions/{solution_name}.zip')}"
+    try:
+        subprocess.run(
+            command, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
         )
-        if solution_name == "AFDCustomizing":
-            subprocess.run(
-                f"pac solution unpack --zipfile ./solutions/{solution_name}.zip --folder {export_path}",
-                shell=True,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-        return update(value=f"./solutions/{solution_name}.zip")
-    else:
-        print(f"Failed to export solution. Error: {process.stderr.decode()}")
 
+        solution_path = os.path.join(export_folder, f"{solution_name}.zip")
+
+        if version is not None:
+            solution_path = artifacts().put(environment, solution_name, version, managed, solution_path)
+    except BaseException:
+        shutil.rmtree(export_folder, ignore_errors=True)
+        raise
+
+    print(f"Solution {solution_name} {version} exported successfully to {os.path.abspath(solution_path)}")
+
+    if version is not None:
+        shutil.rmtree(export_folder, ignore_errors=True)
+        return solution_path, None
+
+    # Unversioned exports stay in the folder of this run, so concurrent runs can not overwrite them
+    return solution_path, export_folder
 
+
+@profiled()
+def export_solution(solution_name, export_path, environment, use_cache: bool = False, progress=Progress()):
+    solution_path = f"./solutions/{solution_name}.zip"
+    exported, export_folder = export_artifact(solution_name, environment, use_cache=use_cache, progress=progress)
+
+    try:
+        shutil.copyfile(exported, solution_path)
+    finally:
+        if export_folder is not None:
+            shutil.rmtree(export_folder, ignore_errors=True)
+
+    if solution_name == "AFDCustomizing":
+        subprocess.run(
+            f"pac solution unpack --zipfile {solution_path} --folder {export_path}",
+            shell=True,
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    return update(value=solution_path)
+
+
+@profiled()
 def transfer_configuration_settings(
-        source_system, target_system, dov, progress=Progress()
+        source_system, target_system, dov, concurrency=1, progress=Progress()
 ):
-    entity = "afd_configurationsettings"
+    entity = CONFIGURATION_SETTINGS
 
-    results = []
-    records = crm().get(source_system, entity)
+    progress(0, desc="Comparing configuration settings...")
 
-    # FILTER
-    for record in progress.tqdm(
-            filter_existing_records(records, target_system),
-            "Transferring configuration settings...",
-            unit="Configuration settings",
-    ):
-        # TODO REMOVE THIS WHEN FUNCTION IS OPTIMIZED
-        if record.already_exists(target_system):
-            continue
+    with Journal(transfer_run_id(entity, source_system, target_system), resume=False) as journal:
+        results = sync(
+            source_system, target_system, journal, delete_old=dov, concurrency=concurrency, progress=progress
+        )
 
-        results.append(crm().post(target_system, entity, record.payload))
+    return update(value=json.dumps(results, indent=4))
+
+
+def retry_configuration_settings(source_system, target_system, dov, concurrency, progress=Progress()):
+    entity = CONFIGURATION_SETTINGS
+
+    with Journal(transfer_run_id(entity, source_system, target_system)) as journal:
+        failed = {entry.source_id for entry in journal.failed()}
+
+        if not failed:
+            return update(value=json.dumps({"message": "No failed configuration settings to retry"}))
+
+        results = sync(
+            source_system,
+            target_system,
+            journal,
+            delete_old=dov,
+            concurrency=concurrency,
+            keys=failed,
+            progress=progress,
+        )
 
-    return update(value=results)
+    return update(value=json.dumps(results, indent=4))
 
 
 def debug(choice, input):
     if choice == 0:
         raise NotImplementedError("Operation not yet supported")
     elif choice == 1:
-        return update(value=crm().post("myxrm-dev01", "accounts", input).json())
+        return update(value=loads(crm().post("myxrm-dev01", "accounts", input).content))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,206 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from configparser import ConfigParser
+
+from logger import logger, LoggerLevel
+
+METADATA_PATH = "./cache/metadata"
+DEFAULT_TTL = 3600
+
+
+class PrefixIndex:
+    """
+    Sorted index over a list of names answering case-insensitive prefix lookups with a binary search.
+    """
+
+    def __init__(self, names: list[str]):
+        self._keys: list[tuple[str, str]] = sorted({(name.lower(), name) for name in names})
+
+    def search(self, prefix: str = "") -> list[str]:
+        prefix = prefix.lower()
+        start = bisect_left(self._keys, (prefix, ""))
+
+        results = []
+        for key, name in self._keys[start:]:
+            if not key.startswith(prefix):
+                break
+            results.append(name)
+
+        return results
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class SystemMetadata:
+
+    def __init__(self, system, entities: list[str], relationships: list[str], fetched_at: float):
+        self.system = system
+        self.entities = entities
+        self.relationships = relationships
+        self.fetched_at = fetched_at
+        self.entity_index = PrefixIndex(entities)
+        self.relationship_index = PrefixIndex(relationships)
+
+    def is_stale(self, ttl: int) -> bool:
+        return time.time() - self.fetched_at > ttl
+
+    def to_dict(self) -> dict:
+        return {
+            "system": self.system,
+            "entities": self.entities,
+            "relationships": self.relationships,
+            "fetched_at": self.fetched_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SystemMetadata":
+        return cls(data["system"], data["entities"], data["relationships"], data["fetched_at"])
+
+
+class MetadataCache:
+    """
+    Cache for the entity and relationship metadata of every system.
+    Metadata is kept in memory and on disk. Stale entries are still answered from the cache
+    while a background thread fetches the current metadata.
+    Implements the singleton pattern to ensure only one instance exists.
+    """
+
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._initialize(*args, **kwargs)
+        return cls._instance
+
+    def _initialize(self, path: str = METADATA_PATH):
+        config = ConfigParser()
+        config.read("conf.ini")
+
+        self.ttl = config.getint("Options", "MetadataTtl", fallback=DEFAULT_TTL)
+        self.path = path
+        self._systems: dict[str, SystemMetadata] = {}
+        self._refreshing: set[str] = set()
+        self._lock = threading.Lock()
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, system) -> str:
+        return os.path.join(self.path, f"{system}.json")
+
+    def _load(self, system) -> SystemMetadata | None:
+        try:
+            with open(self._file(system), "r", encoding="utf-8") as f:
+                return SystemMetadata.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError):
+            logger().log(f"Metadata cache of {system} is corrupt, fetching again", LoggerLevel.WARNING)
+            return None
+
+    def _store(self, metadata: SystemMetadata):
+        tmp = self._file(metadata.system) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(metadata.to_dict(), f)
+        os.replace(tmp, self._file(metadata.system))
+
+    def _fetch(self, system) -> SystemMetadata:
+        from msal_app import crm
+
+        # Both reads follow the next links, a system can have more rows than fit on one page
+        entities = [
+            entity["entitysetname"]
+            for entity in crm().get_rows(system, "entities", "select=entitysetname")
+            if entity.get("entitysetname")
+        ]
+        relationships = [
+            relationship["name"]
+            for relationship in crm().get_rows(system, "relationships", "select=name")
+            if relationship.get("name")
+        ]
+
+        logger().log(f"Fetched metadata of {system}: {len(entities)} entities, {len(relationships)} relationships")
+
+        return SystemMetadata(system, entities, relationships, time.time())
+
+    def refresh(self, system) -> SystemMetadata:
+        """
+        Fetches the metadata of a system from the Web API and updates the memory and disk cache.
+        :param system: Systemname (e.g. 'myxrm-dev01')
+        :return: The fetched metadata
+        """
+        metadata = self._fetch(system)
+
+        with self._lock:
+            self._systems[system] = metadata
+            self._store(metadata)
+
+        return metadata
+
+    def refresh_in_background(self, system):
+        with self._lock:
+            if system in self._refreshing:
+                return
+            self._refreshing.add(system)
+
+        def run():
+            try:
+                self.refresh(system)
+            except Exception as e:
+                logger().log(f"Background refresh of metadata of {system} failed: {e}", LoggerLevel.ERROR)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(system)
+
+        threading.Thread(target=run, name=f"metadata-refresh-{system}", daemon=True).start()
+
+    def get(self, system) -> SystemMetadata:
+        """
+        Returns the metadata of a system, fetching it only if it is neither in memory nor on disk.
+        Stale metadata is returned as is and refreshed in the background.
+        :param system: Systemname (e.g. 'myxrm-dev01')
+        :return: The metadata of the system
+        """
+        metadata = self._systems.get(system)
+
+        if metadata is None:
+            metadata = self._load(system)
+
+            if metadata is None:
+                return self.refresh(system)
+
+            with self._lock:
+                self._systems[system] = metadata
+
+        if metadata.is_stale(self.ttl):
+            self.refresh_in_background(system)
+
+        return metadata
+
+    def entities(self, system, prefix: str = "") -> list[str]:
+        return self.get(system).entity_index.search(prefix)
+
+    def relationships(self, system, prefix: str = "") -> list[str]:
+        return self.get(system).relationship_index.search(prefix)
+
+    def warm(self, systems: list[str]):
+        """
+        Loads the metadata of all systems in the background so the first lookup is answered locally.
+        :param systems: List of systemnames
+        """
+        for system in systems:
+            metadata = self._systems.get(system) or self._load(system)
+
+            if metadata is None or metadata.is_stale(self.ttl):
+                self.refresh_in_background(system)
+            else:
+                with self._lock:
+                    self._systems[system] = metadata
+
+
+def metadata() -> MetadataCache:
+    return MetadataCache()
@@ -2,6 +2,8 @@ from enum import Enum
 from gradio import Error
 from requests import Response
 
+from decoder import loads
+
 from pattern.text.en import singularize, pluralize
 
 
@@ -47,7 +49,7 @@ def to_field_name(entity: str) -> str:
 
 def response_is_error(response: Response):
     try:
-        return response.json()["error"]
+        return loads(response.content)["error"]
     except KeyError:
         return None
 
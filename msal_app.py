@@ -1,40 +1,132 @@
+import asyncio
+import atexit
+import json
 import os
+import re
+import threading
+import uuid
 from configparser import ConfigParser
 
+import httpx
 import msal
 import requests
 from requests import Response
+from requests.adapters import HTTPAdapter
 
+from decoder import ValueParser, iter_values, loads
 from record import Record, known_records
 
 from misc import to_field_name, Ignore
 
+GET_HEADERS = {
+    "Prefer": 'odata.include-annotations="Microsoft.Dynamics.CRM.lookuplogicalname"',
+}
+POST_HEADERS = {
+    "Content-Type": 'application/json',
+    "Prefer"      : "return=representation",
+}
+PATCH_HEADERS = {
+    "Content-Type": 'application/json',
+}
 
-class MsalApp:
+LATENCY_PATH = "./cache/latencies.json"
+CHUNK_SIZE = 64 * 1024
+PAGE_SIZE = 5000
+# Connections kept open per host, shared by all threads using an instance
+POOL_SIZE = 32
+
+# The Web API accepts at most 1000 requests per batch
+BATCH_SIZE = 1000
+_BATCH_STATUS = re.compile(rb"^HTTP/1\.1 (\d{3})", re.MULTILINE)
+# Status of operations missing in a batch response (Failed Dependency, as OData reports skipped operations)
+_BATCH_MISSING_STATUS = 424
+
+
+class LatencyTracker:
     """
-    Wrapper for the msal library with request features for XRM.
-    Implements the singleton pattern to ensure only one instance exists.
+    Collects the measured latency and transferred bytes of the requests per system and method.
+    The measurements are persisted, so estimates can be made before the first request of a session.
+    """
+
+    def __init__(self, path: str = LATENCY_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._stats: dict[str, dict[str, float]] = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._stats = {}
+
+    def add(self, system, method: str, seconds: float, size: int):
+        with self._lock:
+            stats = self._stats.setdefault(f"{system}:{method}", {"count": 0, "seconds": 0.0, "bytes": 0})
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["bytes"] += size
+
+    def average(self, system, method: str) -> float | None:
+        """
+        :return: The average latency in seconds or None if nothing was measured yet
+        """
+        stats = self._stats.get(f"{system}:{method}")
+        return stats["seconds"] / stats["count"] if stats and stats["count"] else None
+
+    def save(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(self._stats, f, indent=4)
+
+
+def _get_url(system, entity: str, filter: str = None) -> str:
+    query = f"?${filter}" if filter else ""
+    return f"https://{system}.crm4.dynamics.com/api/data/v9.2/{entity}{query}"
+
+
+def _write_url(system, entity: str, id: str = None) -> str:
+    key = f"({id})" if id else ""
+    return f"https://{system}.api.crm4.dynamics.com/api/data/v9.2/{entity}{key}"
+
+
+def _to_records(system, entity: str, items, cache_record: bool) -> list[Record]:
     """
+    Converts the rows of a GET response to records, reusing records which are already cached.
+    """
+    records: list[Record] = []
+
+    for item in items:
+        id = item[to_field_name(entity)]
+
+        record = known_records.get(id)
+        if record is not None:
+            print(f"Getting {record.entity} with id {record.id} from dictionary")
+            records.append(record)
+        else:
+            records.append(Record(system, entity, item, cache_record))
+
+    return records
 
-    _instance = None
 
-    def __new__(cls, *args, **kwargs):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance._initialize(*args, **kwargs)
-        return cls._instance
+class MsalApp:
+    """
+    Wrapper for the msal library with request features for XRM.
+    Instances are thread-safe and can either be created per job or shared via `crm()`.
+    All threads share one session with a connection pool of `POOL_SIZE` connections per host.
+    """
 
-    def _initialize(self):
+    def __init__(self, config_path: str = "conf.ini"):
         """
         Initializes the application with the API credentials.
 
-        Reads the API credentials from the environment variables and uses them to create
+        Reads the API credentials from the configuration file and uses them to create
         a `ConfidentialClientApplication` instance for authentication.
 
-        The environment variables should contain the following keys:
-        - "tenant_id": The ID of the Azure AD tenant.
-        - "client_id": The client ID of the application.
-        - "client_secret": The client secret of the application.
+        The section "Authorization" should contain the following keys:
+        - "tenantid": The ID of the Azure AD tenant.
+        - "clientid": The client ID of the application.
+        - "clientsecret": The client secret of the application.
+        :param config_path: Path to the configuration file
         :raises KeyError: If one of the variables does not exist
         """
         try:
@@ -42,7 +134,7 @@ class MsalApp:
             print("Creating confidential client application...")
 
             config = ConfigParser()
-            config.read("conf.ini")
+            config.read(config_path)
             config = dict(config.items("Authorization"))
 
             tenant = config["tenantid"]
@@ -58,6 +150,12 @@ class MsalApp:
             client_credential=client_secret,
         )
 
+        self._token_lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=POOL_SIZE))
+        self.latencies = LatencyTracker()
+        self.closed = False
+
     def generate_token(self, system) -> str:
         """
         Generates a bearer token for authorization.
@@ -71,16 +169,21 @@ class MsalApp:
         """
         scopes = [f"https://{system}.crm4.dynamics.com/.default"]
 
-        result = self.app.acquire_token_silent(scopes=scopes, account=None)
-        if not result:
-            result = self.app.acquire_token_for_client(scopes=scopes)
+        with self._token_lock:
+            result = self.app.acquire_token_silent(scopes=scopes, account=None)
+            if not result:
+                result = self.app.acquire_token_for_client(scopes=scopes)
         return result["access_token"]
 
-    def get(self, system, entity: str, filter: str = None, cache_record: bool = True) -> list[Record]:
+    def get(
+            self, system, entity: str, filter: str = None, cache_record: bool = True, stream: bool = False
+    ) -> list[Record]:
         """
         Retrieves data from a specified entity in a system.
 
         :param cache_record: Flag if the record should be saved in cache for further usage
+        :param stream: Flag if the rows should be parsed while the response is read.
+            Uses more CPU than decoding the complete page but overlaps parsing with the download
         :param system: The system to retrieve data from.
         :type system: str
         :param entity: The entity to retrieve data from.
@@ -91,30 +194,30 @@ class MsalApp:
         :rtype: list[object]
         """
 
-        url = f"https://{system}.crm4.dynamics.com/api/data/v9.2/{entity}{f"?${filter}" if filter else ""}"
-        response = requests.get(
+        url = _get_url(system, entity, filter)
+        response = self.session.get(
             url,
             headers={
                 "Authorization": f"Bearer {self.generate_token(system)}",
-                "Prefer"       : 'odata.include-annotations="Microsoft.Dynamics.CRM.lookuplogicalname"',
+                **GET_HEADERS,
             },
+            stream=stream,
         )
-        records: list[Record] = []
 
-        try:
-            response = response.json()["value"]
-        except KeyError:
-            print(url)
+        if stream:
+            parser = ValueParser()
+            records = _to_records(
+                system, entity, iter_values(response.iter_content(CHUNK_SIZE), parser), cache_record
+            )
+            body, size = parser.envelope, parser.size
+        else:
+            body, size = loads(response.content), len(response.content)
+            records = _to_records(system, entity, body.get("value", []), cache_record)
 
-        for item in list(response):
-            id = item[to_field_name(entity)]
+        self.latencies.add(system, "GET", response.elapsed.total_seconds(), size)
 
-            if id in known_records:
-                record = known_records[id]
-                print(f"Getting {record.entity} with id {record.id} from dictionary")
-                records.append(record)
-            else:
-                records.append(Record(system, entity, item, cache_record))
+        if "value" not in body:
+            print(url)
 
         return records
 
@@ -131,16 +234,16 @@ class MsalApp:
         :return: The response object from the POST request.
         :rtype: object
         """
-        url = f"https://{system}.api.crm4.dynamics.com/api/data/v9.2/{entity}"
-        return requests.post(
-            url,
+        response = self.session.post(
+            _write_url(system, entity),
             headers={
                 "Authorization": f"Bearer {self.generate_token(system)}",
-                "Content-Type": 'application/json',
-                "Prefer"       : "return=representation",
+                **POST_HEADERS,
             },
             json=payload,
         )
+        self.latencies.add(system, "POST", response.elapsed.total_seconds(), len(response.request.body or b""))
+        return response
 
     def patch(self, system, entity: str, id: str, data: object) -> Response:
         """
@@ -156,16 +259,248 @@ class MsalApp:
         :return: The response object from the PATCH request.
         :rtype: object
         """
-        url = f"https://{system}.api.crm4.dynamics.com/api/data/v9.2/{entity}({id})"
-        return requests.patch(
-            url,
+        response = self.session.patch(
+            _write_url(system, entity, id),
+            headers={
+                "Authorization": f"Bearer {self.generate_token(system)}",
+                **PATCH_HEADERS,
+            },
+            json=data,
+        )
+        self.latencies.add(system, "PATCH", response.elapsed.total_seconds(), len(response.request.body or b""))
+        return response
+
+    def iter_pages(self, system, entity: str, filter: str = None, page_size: int = PAGE_SIZE):
+        """
+        Retrieves the raw rows of an entity page by page, following the next links of the Web API.
+        The rows are not converted to records and not taken from the record cache.
+
+        :param system: The system to retrieve data from.
+        :param entity: The entity to retrieve data from.
+        :param filter: The filter to apply to the data retrieval.
+        :param page_size: Maximum number of rows per page.
+        :return: Generator of lists of rows
+        """
+        url = _get_url(system, entity, filter)
+
+        while url:
+            response = self.session.get(
+                url,
+                headers={
+                    "Authorization": f"Bearer {self.generate_token(system)}",
+                    "Prefer": f'{GET_HEADERS["Prefer"]},odata.maxpagesize={page_size}',
+                },
+            )
+            self.latencies.add(system, "GET", response.elapsed.total_seconds(), len(response.content))
+
+            body = loads(response.content)
+            if "value" not in body:
+                print(url)
+
+            yield body.get("value", [])
+
+            url = body.get("@odata.nextLink")
+
+    def iter_records(
+            self, system, entity: str, filter: str = None, cache_record: bool = True, page_size: int = PAGE_SIZE
+    ):
+        """
+        Retrieves the records of an entity page by page, so only one page is held in memory at once.
+        See `iter_pages`.
+
+        :return: Generator of records
+        """
+        for page in self.iter_pages(system, entity, filter, page_size):
+            yield from _to_records(system, entity, page, cache_record)
+
+    def get_rows(self, system, entity: str, filter: str = None) -> list[dict]:
+        """
+        Retrieves all raw rows of an entity, see `iter_pages`.
+        """
+        return [row for page in self.iter_pages(system, entity, filter) for row in page]
+
+    def delete(self, system, entity: str, id: str) -> Response:
+        """
+        Performs a DELETE request to remove an entity from the specified system.
+
+        :param system: The system where the entity exists.
+        :param entity: The entity to delete.
+        :param id: The ID of the entity to delete.
+        :return: The response object from the DELETE request.
+        """
+        response = self.session.delete(
+            _write_url(system, entity, id),
+            headers={"Authorization": f"Bearer {self.generate_token(system)}"},
+        )
+        self.latencies.add(system, "DELETE", response.elapsed.total_seconds(), 0)
+        return response
+
+    def batch(self, system, operations: list[tuple[str, str, str | None, object]]) -> list[int]:
+        """
+        Sends several write operations in one $batch request. The operations are independent,
+        a failing one does not stop the others.
+
+        :param system: The system to write to.
+        :param operations: Tuples of method, entity, id (None for POST) and payload (None for DELETE).
+            At most `BATCH_SIZE` operations are allowed.
+        :return: The HTTP status code of every operation in the given order.
+            Operations without a part in the response did not run and get a failure status.
+        """
+        boundary = f"batch_{uuid.uuid4()}"
+        parts = []
+
+        for method, entity, id, payload in operations:
+            part = (
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                "Content-Transfer-Encoding: binary\r\n\r\n"
+                f"{method} {_write_url(system, entity, id)} HTTP/1.1\r\n"
+            )
+            if payload is not None:
+                part += f"Content-Type: application/json\r\n\r\n{json.dumps(payload)}\r\n"
+            else:
+                part += "\r\n"
+            parts.append(part)
+
+        body = ("".join(parts) + f"--{boundary}--\r\n").encode("utf-8")
+
+        response = self.session.post(
+            _write_url(system, "$batch"),
             headers={
                 "Authorization": f"Bearer {self.generate_token(system)}",
-                "Content-Type": 'application/json',
+                "Content-Type": f"multipart/mixed; boundary={boundary}",
+                "Prefer": "odata.continue-on-error",
+            },
+            data=body,
+        )
+        self.latencies.add(system, "BATCH", response.elapsed.total_seconds(), len(body))
+
+        if not response.ok and not response.content.startswith(b"--"):
+            # The whole batch was rejected
+            return [response.status_code] * len(operations)
+
+        statuses = [int(status) for status in _BATCH_STATUS.findall(response.content)]
+        if len(statuses) < len(operations):
+            print(f"Batch response contains {len(statuses)} of {len(operations)} operations")
+        return statuses + [_BATCH_MISSING_STATUS] * (len(operations) - len(statuses))
+
+    def close(self):
+        """
+        Saves the measured latencies and closes the pooled connections.
+        """
+        self.latencies.save()
+        self.closed = True
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class AsyncMsalApp:
+    """
+    Async variant of `MsalApp` built on a pooled `httpx.AsyncClient`.
+    Tokens are acquired through a (shared) `MsalApp` in a worker thread, because msal is synchronous.
+    """
+
+    def __init__(self, app: MsalApp = None, max_connections: int = 20):
+        """
+        :param app: The application used to acquire tokens. Defaults to the shared instance of `crm()`
+        :param max_connections: Maximum number of pooled connections
+        """
+        self.app = app or crm()
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections),
+            timeout=httpx.Timeout(60.0),
+        )
+
+    async def generate_token(self, system) -> str:
+        return await asyncio.to_thread(self.app.generate_token, system)
+
+    async def get(self, system, entity: str, filter: str = None, cache_record: bool = True) -> list[Record]:
+        """
+        Retrieves data from a specified entity in a system.
+        See `MsalApp.get`.
+        """
+        url = _get_url(system, entity, filter)
+        response = await self.client.get(
+            url,
+            headers={
+                "Authorization": f"Bearer {await self.generate_token(system)}",
+                **GET_HEADERS,
+            },
+        )
+        self.app.latencies.add(system, "GET", response.elapsed.total_seconds(), len(response.content))
+
+        body = loads(response.content)
+        if "value" not in body:
+            print(url)
+
+        return _to_records(system, entity, body.get("value", []), cache_record)
+
+    async def post(self, system, entity: str, payload: object) -> httpx.Response:
+        """
+        Performs a POST request to create a new entity in the specified system.
+        See `MsalApp.post`.
+        """
+        response = await self.client.post(
+            _write_url(system, entity),
+            headers={
+                "Authorization": f"Bearer {await self.generate_token(system)}",
+                **POST_HEADERS,
+            },
+            json=payload,
+        )
+        self.app.latencies.add(system, "POST", response.elapsed.total_seconds(), len(response.request.content))
+        return response
+
+    async def patch(self, system, entity: str, id: str, data: object) -> httpx.Response:
+        """
+        Performs a PATCH request to update an entity in the specified system.
+        See `MsalApp.patch`.
+        """
+        response = await self.client.patch(
+            _write_url(system, entity, id),
+            headers={
+                "Authorization": f"Bearer {await self.generate_token(system)}",
+                **PATCH_HEADERS,
             },
             json=data,
         )
+        self.app.latencies.add(system, "PATCH", response.elapsed.total_seconds(), len(response.request.content))
+        return response
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+
+_shared_app: MsalApp | None = None
+_shared_lock = threading.Lock()
 
 
 def crm() -> MsalApp:
-    return MsalApp()
+    """
+    Returns the application shared by the whole process. It is created on first use.
+    """
+    global _shared_app
+
+    if _shared_app is None or _shared_app.closed:
+        with _shared_lock:
+            if _shared_app is None or _shared_app.closed:
+                _shared_app = MsalApp()
+
+    return _shared_app
+
+
+@atexit.register
+def close_crm():
+    if _shared_app is not None:
+        _shared_app.close()
@@ -0,0 +1,246 @@
+import os
+import queue
+import threading
+import time
+from configparser import ConfigParser
+from typing import Callable, Iterable
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from logger import logger, LoggerLevel
+from profiler import inherit
+from record import RecordCache
+
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_MEMORY_BUDGET_MB = 1024
+# Seconds between two measurements of the memory
+MEMORY_CHECK_INTERVAL = 0.25
+# Megabytes the memory has to grow by before records are evicted again
+EVICTION_STEP_MB = 64
+
+# Marks the end of the items of a queue
+_DONE = object()
+
+
+def resident_memory() -> int | None:
+    """
+    :return: The resident set size of the process in bytes or None if it can not be measured
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class StageStats:
+
+    def __init__(self, name: str, output: bool = True):
+        """
+        :param name: Name of the stage
+        :param output: Flag if the stage feeds a queue, the last stage does not
+        """
+        self.name = name
+        self.items = 0
+        self.seconds = 0.0
+        # Peak number of items waiting in the output queue of the stage
+        self.peak_queue: int | None = 0 if output else None
+
+    def to_dict(self) -> dict:
+        stats = {"items": self.items, "seconds": round(self.seconds, 2)}
+        if self.peak_queue is not None:
+            stats["peak_output_queue"] = self.peak_queue
+        return stats
+
+
+class BoundedPipeline:
+    """
+    Runs fetch, transform and post of a transfer as three stages connected by fixed-size queues.
+    Only the fetch and transform stages run ahead of the post stage, so they must not depend on its writes.
+
+    A full queue blocks the stage in front of it, so at most `queue_size` items wait between two stages
+    no matter how fast the source is read. The resident memory of the process is measured while the
+    pipeline runs. Whenever it exceeds the budget, a quarter of the record cache is spilled to disk.
+    Freed memory is usually kept by the process for new records rather than returned, so records are only
+    spilled again once the memory grew further. Memory held outside the cache does not empty the cache.
+    """
+
+    def __init__(self, cache: RecordCache, queue_size: int = None, memory_budget_mb: int = None):
+        config = ConfigParser()
+        config.read("conf.ini")
+
+        self.cache = cache
+        self.queue_size = queue_size or config.getint("Options", "PipelineQueueSize", fallback=DEFAULT_QUEUE_SIZE)
+        self.memory_budget = (
+                memory_budget_mb or config.getint("Options", "MemoryBudgetMb", fallback=DEFAULT_MEMORY_BUDGET_MB)
+        ) * 1024 * 1024
+        self.stats: dict[str, StageStats] = {}
+        self.evicted = 0
+        # Memory is measured for the whole process, stages share it and can not be told apart
+        self.peak_memory = 0
+        self._stop = threading.Event()
+        self._error: BaseException | None = None
+        self._budget_lock = threading.Lock()
+        self._last_check = 0.0
+        # Memory after the last eviction, None if nothing was evicted yet
+        self._evicted_at: int | None = None
+        self._warned = False
+
+    def _check_memory(self, stats: StageStats):
+        now = time.monotonic()
+        if now - self._last_check < MEMORY_CHECK_INTERVAL or not self._budget_lock.acquire(blocking=False):
+            return
+
+        try:
+            self._last_check = now
+            current = resident_memory()
+            if current is None:
+                return
+            self.peak_memory = max(self.peak_memory, current)
+
+            if current <= self.memory_budget:
+                self._evicted_at = None
+                return
+
+            if self._evicted_at is not None and current < self._evicted_at + EVICTION_STEP_MB * 1024 * 1024:
+                # The last eviction did not bring the memory below the budget and the cache did not grow much since
+                if not self._warned:
+                    logger().log(
+                        f"Memory budget of {self.memory_budget} bytes exceeded by stage {stats.name} "
+                        f"with {self.cache.in_memory()} cached records",
+                        LoggerLevel.WARNING,
+                    )
+                    self._warned = True
+                return
+
+            if self.cache.in_memory():
+                self.evicted += self.cache.evict(max(1, self.cache.in_memory() // 4))
+            self._evicted_at = current
+        finally:
+            self._budget_lock.release()
+
+    def _put(self, target: queue.Queue, item, stats: StageStats):
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.5)
+                stats.peak_queue = max(stats.peak_queue, target.qsize())
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, source: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _fail(self, error: BaseException):
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+    def _produce(self, items: Iterable, output: queue.Queue, stats: StageStats):
+        try:
+            iterator = iter(items)
+            while not self._stop.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                stats.seconds += time.perf_counter() - start
+                stats.items += 1
+                self._check_memory(stats)
+                self._put(output, item, stats)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put(output, _DONE, stats)
+
+    def _transform(self, transform: Callable, source: queue.Queue, output: queue.Queue, stats: StageStats):
+        try:
+            while True:
+                item = self._get(source)
+                if item is _DONE:
+                    break
+
+                start = time.perf_counter()
+                result = transform(item)
+                stats.seconds += time.perf_counter() - start
+                stats.items += 1
+                self._check_memory(stats)
+
+                if result is not None:
+                    self._put(output, result, stats)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put(output, _DONE, stats)
+
+    def run(self, items: Iterable, transform: Callable, sink: Callable):
+        """
+        Runs the pipeline. Items returned as None by `transform` are not passed to the sink.
+        The sink runs in the calling thread, so it may report progress to gradio.
+        :param items: Source of the items, e.g. a generator reading the pages of the Web API
+        :param transform: Function preparing an item for the sink
+        :param sink: Function consuming the prepared items
+        :raises BaseException: The first error raised by any stage
+        """
+        fetch_stats, transform_stats, sink_stats = (
+            StageStats("fetch"), StageStats("transform"), StageStats("post", output=False)
+        )
+        self.stats = {stats.name: stats for stats in (fetch_stats, transform_stats, sink_stats)}
+        self.peak_memory = 0
+
+        fetched = queue.Queue(maxsize=self.queue_size)
+        transformed = queue.Queue(maxsize=self.queue_size)
+
+        threads = [
+            threading.Thread(target=inherit(self._produce), args=(items, fetched, fetch_stats), name="pipeline-fetch"),
+            threading.Thread(
+                target=inherit(self._transform),
+                args=(transform, fetched, transformed, transform_stats),
+                name="pipeline-transform",
+            ),
+        ]
+
+        try:
+            for thread in threads:
+                thread.start()
+
+            while True:
+                item = self._get(transformed)
+                if item is _DONE:
+                    break
+
+                start = time.perf_counter()
+                sink(item)
+                sink_stats.seconds += time.perf_counter() - start
+                sink_stats.items += 1
+                self._check_memory(sink_stats)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+    def report(self) -> dict:
+        return {
+            "stages": {name: stats.to_dict() for name, stats in self.stats.items()},
+            "memory_budget_mb": self.memory_budget // 1024 // 1024,
+            "memory_measured": resident_memory() is not None,
+            "peak_rss_mb": round(self.peak_memory / 1024 / 1024, 1),
+            "spilled_records": self.evicted,
+        }
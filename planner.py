@@ -0,0 +1,211 @@
+import json
+
+from journal import JournalStatus, read_journal, transfer_run_id
+from msal_app import crm, PAGE_SIZE
+from record import Record, Reference, ReferenceResolver, known_records
+
+# Fallback latencies in seconds if a system was never measured
+DEFAULT_LATENCY = {"GET": 0.3, "POST": 0.6}
+
+# Service protection limit of the Web API: requests per user within a sliding window of 5 minutes
+THROTTLING_REQUESTS = 6000
+THROTTLING_WINDOW = 300
+
+
+class TransferPlan:
+    """
+    Result of a dry run of `transfer_data`. Counts what a real run would do and the requests it would cost.
+    """
+
+    def __init__(self, source_system, target_system, entity: str, filter: str):
+        self.source_system = source_system
+        self.target_system = target_system
+        self.entity = entity
+        self.filter = filter
+
+        self.create: list[str] = []
+        self.skip: list[str] = []
+        self.journaled: list[str] = []
+        self.bind = 0
+        self.insert = 0
+        self.unresolved = 0
+
+        # Requests a real run issues, by system
+        self.source_gets = 1
+        self.target_gets = 0
+        self.posts = 0
+        self.payload_bytes = 0
+
+    def estimate_seconds(self) -> dict[str, float | bool]:
+        """
+        Estimates the wall-clock time of the run from the measured latencies of both systems.
+        The estimate is never lower than the time the throttling limits allow for the number of requests.
+        """
+        latencies = crm().latencies
+
+        def latency(system, method):
+            return latencies.average(system, method)
+
+        measured = all(
+            latency(system, method) is not None
+            for system, method in [
+                (self.source_system, "GET"),
+                (self.target_system, "GET"),
+                (self.target_system, "POST"),
+            ]
+        )
+
+        sequential = (
+                self.source_gets * (latency(self.source_system, "GET") or DEFAULT_LATENCY["GET"])
+                + self.target_gets * (latency(self.target_system, "GET") or DEFAULT_LATENCY["GET"])
+                + self.posts * (latency(self.target_system, "POST") or DEFAULT_LATENCY["POST"])
+        )
+
+        # Both systems are throttled separately, the busier one bounds the run
+        busiest = max(self.source_gets, self.target_gets + self.posts)
+        throttled = busiest / THROTTLING_REQUESTS * THROTTLING_WINDOW if busiest > THROTTLING_REQUESTS else 0
+
+        return {
+            "sequential_seconds": round(sequential, 1),
+            "throttling_floor_seconds": round(throttled, 1),
+            "estimated_seconds": round(max(sequential, throttled), 1),
+            "measured_latencies": measured,
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            "entity": self.entity,
+            "filter": self.filter,
+            "records": {
+                "create": len(self.create),
+                "skip_existing": len(self.skip),
+                "skip_journaled": len(self.journaled),
+            },
+            "references": {
+                "bind": self.bind,
+                "insert": self.insert,
+                "unresolved": self.unresolved,
+            },
+            "requests": {
+                "source_gets": self.source_gets,
+                "target_gets": self.target_gets,
+                "posts": self.posts,
+                "total": self.source_gets + self.target_gets + self.posts,
+            },
+            "payload_bytes": self.payload_bytes,
+            "time": self.estimate_seconds(),
+            "create_ids": self.create,
+        }
+
+
+class _CachedResolver(ReferenceResolver):
+    """
+    Resolver answering from the record cache and the journal of the run before issuing requests.
+    """
+
+    def __init__(self, target_system, existing: set[str]):
+        super().__init__(target_system)
+        self.existing = existing
+
+    def get_record(self, reference: Reference) -> Record:
+        record = known_records.get(reference.id)
+        return record if record is not None else super().get_record(reference)
+
+    def exists(self, record: Record) -> bool:
+        return record.id in self.existing or super().exists(record)
+
+
+def plan_record(
+        plan: TransferPlan,
+        record: Record,
+        resolver: ReferenceResolver,
+        already_traversed: set[str],
+        inserted: set[str],
+) -> int:
+    """
+    Walks the references of a record like `traverse_record` without changing its payload.
+    :param inserted: Collects the ids of references a real run would insert together with the record
+    :return: The size in bytes of the payload a real run would post for the record
+    """
+    if record.id in already_traversed:
+        return 0
+    already_traversed.add(record.id)
+
+    size = len(json.dumps(record.payload, default=str).encode("utf-8"))
+
+    for reference in record.references.values():
+        ref_rec = resolver.get_record(reference)
+        plan.source_gets += 1
+
+        if ref_rec is None:
+            plan.unresolved += 1
+            continue
+
+        if ref_rec.entity == "teams":
+            plan_record(plan, ref_rec, resolver, already_traversed, inserted)
+
+        if reference.id in already_traversed:
+            exists = True
+        else:
+            plan.target_gets += 1
+            exists = resolver.exists(ref_rec) or ref_rec.entity == "systemusers"
+
+        if exists:
+            plan.bind += 1
+            size += len(f'"{reference.key}@odata.bind": "/{reference.entity}({ref_rec.id})", ')
+            continue
+
+        plan.insert += 1
+        inserted.add(ref_rec.id)
+        size += len(f'"{reference.key}": , ') + plan_record(plan, ref_rec, resolver, already_traversed, inserted)
+
+    return size
+
+
+def plan_transfer(source_system, target_system, entity: str, filter: str) -> TransferPlan:
+    """
+    Plans a transfer without writing to the target system. Records and references are taken from the
+    record cache and existence from the journal of the run where possible.
+    :param source_system: The system the records are read from
+    :param target_system: The system the records would be posted to
+    :param entity: The entity to transfer
+    :param filter: The filter of the transfer
+    :return: The plan of the transfer
+    """
+    plan = TransferPlan(source_system, target_system, entity, filter)
+
+    entries = read_journal(transfer_run_id(entity, source_system, target_system, filter))
+    existing = {
+        entry.target_id or source_id
+        for source_id, entry in entries.items()
+        if entry.status != JournalStatus.FAILED
+    }
+    resolver = _CachedResolver(target_system, existing)
+
+    records = 0
+
+    for record in crm().iter_records(source_system, entity, filter):
+        records += 1
+
+        if record.id in entries and entries[record.id].status != JournalStatus.FAILED:
+            plan.journaled.append(record.id)
+            continue
+
+        plan.target_gets += 1
+
+        if resolver.exists(record):
+            plan.skip.append(record.id)
+            continue
+
+        inserted = set()
+        plan.create.append(record.id)
+        plan.posts += 1
+        plan.payload_bytes += plan_record(plan, record, resolver, set(), inserted)
+
+        # Later records bind to everything this record would have created
+        resolver.existing.update(inserted | {record.id})
+
+    # Every further page of the source result is one more request
+    plan.source_gets += max(0, records - 1) // PAGE_SIZE
+
+    return plan
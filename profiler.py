@@ -0,0 +1,267 @@
+import cProfile
+import functools
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime
+from enum import Enum
+
+from logger import logger
+
+PROFILE_PATH = "./logs"
+SAMPLE_INTERVAL = 0.005
+TOP_N = 25
+
+# Threads sampled by the profiled run the calling thread belongs to
+_run_threads = threading.local()
+
+
+class ProfileMode(Enum):
+    SAMPLING = "Sampling"
+    DETERMINISTIC = "Deterministic"
+
+
+class ProfileResult:
+
+    def __init__(self, run_id: str, name: str, started: datetime, seconds: float, samples: Counter,
+                 folded_path: str, stats_path: str | None, stats: pstats.Stats | None):
+        self.run_id = run_id
+        self.name = name
+        self.started = started
+        self.seconds = seconds
+        self.samples = samples
+        self.folded_path = folded_path
+        self.stats_path = stats_path
+        self.stats = stats
+
+    @property
+    def label(self) -> str:
+        return f"{self.started.strftime('%d.%m.%Y_%H-%M-%S')} {self.name} ({self.seconds:.1f}s) [{self.run_id}]"
+
+    @property
+    def headers(self) -> list[str]:
+        if self.stats is not None:
+            return ["Function", "Own time (s)", "Cumulative time (s)"]
+        return ["Function", "Own samples (%)", "Total samples (%)"]
+
+    def top(self, n: int = TOP_N) -> list[list]:
+        """
+        Returns the hottest functions. Deterministic profiles are ranked by their own time in the
+        profiled thread, sampled profiles by the share of samples across all threads of the run.
+        :param n: Number of functions
+        :return: Rows of function, own and cumulative value
+        """
+        if self.stats is not None:
+            rows = [
+                [f"{function} ({os.path.basename(file)}:{line})", round(tottime, 4), round(cumtime, 4)]
+                for (file, line, function), (_, _, tottime, cumtime, _) in self.stats.stats.items()
+            ]
+            return sorted(rows, key=lambda row: row[1], reverse=True)[:n]
+
+        total = sum(self.samples.values()) or 1
+        own = Counter()
+        cumulative = Counter()
+
+        for stack, count in self.samples.items():
+            frames = stack.split(";")[1:]
+            if frames:
+                own[frames[-1]] += count
+            for frame in set(frames):
+                cumulative[frame] += count
+
+        return [
+            [frame, round(count / total * 100, 1), round(cumulative[frame] / total * 100, 1)]
+            for frame, count in own.most_common(n)
+        ]
+
+
+def inherit(function):
+    """
+    Wraps a function which runs in another thread, so the thread is sampled together with the profiled
+    run that started it. Threads of other requests are never attributed to a run.
+    Call it in the starting thread, e.g. `executor.submit(inherit(send), batch)`.
+    """
+    threads: set[int] | None = getattr(_run_threads, "current", None)
+
+    if threads is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        ident = threading.get_ident()
+        previous = getattr(_run_threads, "current", None)
+        threads.add(ident)
+        _run_threads.current = threads
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            # Pooled threads go on to run work of other requests
+            threads.discard(ident)
+            _run_threads.current = previous
+
+    return wrapper
+
+
+class _Sampler(threading.Thread):
+    """
+    Samples the stacks of the profiled thread and of the threads it started with `inherit`.
+    """
+
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL):
+        super().__init__(name="profiler-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.threads = {thread_id}
+        self._running = threading.Event()
+        self._running.set()
+
+    def run(self):
+        names = {}
+
+        while self._running.is_set():
+            for ident, frame in sys._current_frames().items():
+                if ident not in self.threads:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+
+                if ident not in names:
+                    thread = next((t for t in threading.enumerate() if t.ident == ident), None)
+                    names[ident] = thread.name if thread else str(ident)
+
+                self.samples[";".join([names[ident], *reversed(stack)])] += 1
+
+            time.sleep(self.interval)
+
+    def stop(self) -> Counter:
+        self._running.clear()
+        self.join()
+        return self.samples
+
+
+class Profiler:
+    """
+    Opt-in profiling of runs. Implements the singleton pattern to ensure only one instance exists.
+    """
+
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._initialize(*args, **kwargs)
+        return cls._instance
+
+    def _initialize(self, path: str = PROFILE_PATH):
+        self.path = path
+        self.enabled = False
+        self.mode = ProfileMode.SAMPLING
+        self.results: deque[ProfileResult] = deque(maxlen=20)
+        # Only one cProfile profiler can be active in the process
+        self._deterministic_lock = threading.Lock()
+
+    def configure(self, enabled: bool, mode: ProfileMode):
+        self.enabled = enabled
+        self.mode = mode
+
+    def find(self, label: str) -> ProfileResult | None:
+        return next((result for result in self.results if result.label == label), None)
+
+    def run(self, name: str, function, *args, **kwargs):
+        """
+        Runs a function and saves its profile next to the run logs.
+        A flamegraph-compatible file of folded stacks is always written, the deterministic mode also
+        writes a cProfile file of the calling thread. While another deterministic run is active,
+        the run is only sampled.
+        """
+        started = datetime.now()
+        # Runs of the same function can start within the same second
+        run_id = uuid.uuid4().hex[:8]
+        prefix = os.path.join(self.path, f"{started.strftime('%d.%m.%Y_%H-%M-%S')}_{name}_{run_id}")
+        os.makedirs(self.path, exist_ok=True)
+
+        sampler = _Sampler(threading.get_ident())
+        profile = None
+
+        if self.mode == ProfileMode.DETERMINISTIC:
+            if self._deterministic_lock.acquire(blocking=False):
+                profile = cProfile.Profile()
+            else:
+                logger().log(f"Another run is profiled deterministically, sampling {name} only")
+
+        previous = getattr(_run_threads, "current", None)
+        _run_threads.current = sampler.threads
+        sampler.start()
+        start = time.perf_counter()
+
+        try:
+            if profile is not None:
+                try:
+                    profile.enable()
+                except ValueError as e:
+                    # Another profiling tool (e.g. a debugger) is active
+                    logger().log(f"Could not profile {name} deterministically, sampling only: {e}")
+                    profile = None
+                    self._deterministic_lock.release()
+
+            return function(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+                self._deterministic_lock.release()
+            samples = sampler.stop()
+            _run_threads.current = previous
+
+            with open(f"{prefix}.folded", "w", encoding="utf-8") as f:
+                for stack, count in samples.items():
+                    f.write(f"{stack} {count}\n")
+
+            stats = None
+            if profile is not None:
+                profile.dump_stats(f"{prefix}.prof")
+                stats = pstats.Stats(profile)
+
+            result = ProfileResult(
+                run_id,
+                name,
+                started,
+                seconds,
+                samples,
+                f"{prefix}.folded",
+                f"{prefix}.prof" if profile is not None else None,
+                stats,
+            )
+            self.results.appendleft(result)
+            logger().log(f"Profiled {name} in {seconds:.1f}s with {sum(samples.values())} samples: {prefix}")
+
+
+def profiler() -> Profiler:
+    return Profiler()
+
+
+def profiled(name: str = None):
+    """
+    Decorator profiling the function with `profiler()` whenever profiling is enabled.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler().enabled:
+                return function(*args, **kwargs)
+            return profiler().run(name or function.__name__, function, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,4 +1,9 @@
+import os
 import pickle
+import shelve
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 
 from misc import to_field_name, to_plural
 from misc import Ignore
@@ -80,19 +85,161 @@ def get_record(system, entity: str, id: str) -> Record:
     return records[0] if records else None
 
 
-# TODO: OPTIMIZE FUNCTION -> INPUT A LIST AND COMPARE RESULTS. THIS WILL USE ONLY ONE API CALL
-# This will only work with entities that are equal
-def filter_existing_records(records: list[Record], target_system) -> list[Record]:
-    return records
+SPILL_PATH = "./cache/records.spill"
+
+
+class RecordCache:
+    """
+    Thread-safe cache of records by id.
+    The ids are distributed over several shards, each guarded by its own lock,
+    so concurrent transfers only contend when they touch the same shard.
+
+    Every shard keeps its records in least recently used order. `evict` moves the oldest records
+    to a spill file on disk, from which they are loaded again on the next access.
+    """
+
+    def __init__(self, records: dict[str, Record] = None, shards: int = 16, spill_path: str = SPILL_PATH):
+        self._shards: list[OrderedDict[str, Record]] = [OrderedDict() for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._spill_path = spill_path
+        self._spill: shelve.Shelf | None = None
+        self._spill_lock = threading.Lock()
+        self.spilled = 0
+
+        if records:
+            self.update(records)
+
+    def _index(self, id: str) -> int:
+        return hash(id) % len(self._shards)
+
+    def _unspill(self, id: str) -> Record | None:
+        if not self.spilled:
+            return None
+
+        with self._spill_lock:
+            if self._spill is None or id not in self._spill:
+                return None
+            record = self._spill.pop(id)
+            self.spilled -= 1
+
+        self[id] = record
+        return record
+
+    def __contains__(self, id: str) -> bool:
+        if id in self._shards[self._index(id)]:
+            return True
+
+        with self._spill_lock:
+            return self._spill is not None and id in self._spill
+
+    def __getitem__(self, id: str) -> Record:
+        record = self.get(id)
+        if record is None:
+            raise KeyError(id)
+        return record
+
+    def __setitem__(self, id: str, record: Record):
+        index = self._index(id)
+        with self._locks[index]:
+            self._shards[index][id] = record
+            self._shards[index].move_to_end(id)
+
+    def __delitem__(self, id: str):
+        index = self._index(id)
+        with self._locks[index]:
+            del self._shards[index][id]
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards) + self.spilled
+
+    def get(self, id: str, default: Record = None) -> Record | None:
+        index = self._index(id)
+        with self._locks[index]:
+            record = self._shards[index].get(id)
+            if record is not None:
+                self._shards[index].move_to_end(id)
+                return record
+
+        record = self._unspill(id)
+        return record if record is not None else default
+
+    def setdefault(self, id: str, record: Record) -> Record:
+        existing = self.get(id)
+        if existing is not None:
+            return existing
+
+        index = self._index(id)
+        with self._locks[index]:
+            return self._shards[index].setdefault(id, record)
+
+    def update(self, records):
+        items = records.items() if hasattr(records, "items") else records
+        for id, record in items:
+            self[id] = record
+
+    def items(self) -> list[tuple[str, Record]]:
+        items = []
+        for index, shard in enumerate(self._shards):
+            with self._locks[index]:
+                items.extend(shard.items())
+        return items
+
+    def values(self) -> list[Record]:
+        return [record for _, record in self.items()]
+
+    def copy(self) -> dict[str, Record]:
+        return dict(self.items())
+
+    def in_memory(self) -> int:
+        return sum(len(shard) for shard in self._shards)
+
+    def evict(self, count: int) -> int:
+        """
+        Moves the least recently used records of every shard to the spill file.
+        :param count: Number of records to evict
+        :return: Number of records evicted
+        """
+        evicted = []
+        per_shard = max(1, count // len(self._shards))
+
+        for index, shard in enumerate(self._shards):
+            with self._locks[index]:
+                for _ in range(min(per_shard, len(shard))):
+                    evicted.append(shard.popitem(last=False))
+
+        if not evicted:
+            return 0
+
+        with self._spill_lock:
+            if self._spill is None:
+                os.makedirs(os.path.dirname(self._spill_path), exist_ok=True)
+                self._spill = shelve.open(self._spill_path, flag="n")
+            for id, record in evicted:
+                self._spill[id] = record
+            self.spilled += len(evicted)
+
+        if self is known_records:
+            # The snapshot of the pickle cache would keep the spilled records in memory
+            for id, _ in evicted:
+                loaded_records.pop(id, None)
+
+        logger().log(f"Spilled {len(evicted)} records to {self._spill_path}")
+        return len(evicted)
+
+    def __getstate__(self):
+        return {"shards": len(self._shards), "records": self.copy()}
+
+    def __setstate__(self, state):
+        self.__init__(state["records"], state["shards"])
 
 
 try:
     with open("cache.pkl", "rb") as f:
-        known_records: dict[str, Record] = pickle.load(f)
+        known_records = RecordCache(pickle.load(f))
         loaded_records = known_records.copy()
 except (EOFError, FileNotFoundError) as e:
     logger().log("Error: 'cache.pkl' is empty or contains invalid pickled data.", LoggerLevel.WARNING)
-    known_records: dict[str, Record] = {}
+    known_records = RecordCache()
     loaded_records = known_records.copy()
 
 logger().log(f"Loaded {len(known_records)} records from pickle cache")
@@ -108,3 +255,93 @@ class Reference:
 
     def get_record(self) -> Record:
         return get_record(self.system, self.entity, self.id)
+
+
+class ReferenceResolver:
+    """
+    Resolves referenced records and their existence in the target system once per run,
+    so that records of several entities sharing a reference do not fetch and check it again.
+    Concurrent lookups of the same key wait for the first one instead of issuing their own request.
+    Records which do not exist yet are claimed by a single inserter, see `claim`.
+    """
+
+    def __init__(self, target_system):
+        self.target_system = target_system
+        self._records: dict[str, Future] = {}
+        self._exists: dict[str, Future] = {}
+        self._claims: dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def _once(self, cache: dict[str, Future], key: str, resolve):
+        with self._lock:
+            future = cache.get(key)
+            owner = future is None
+            if owner:
+                future = cache[key] = Future()
+
+        if owner:
+            try:
+                future.set_result(resolve())
+            except Exception as e:
+                with self._lock:
+                    cache.pop(key, None)
+                future.set_exception(e)
+
+        return future.result()
+
+    def get_record(self, reference: Reference) -> Record:
+        return self._once(self._records, reference.id, reference.get_record)
+
+    def exists(self, record: Record) -> bool:
+        return self._once(self._exists, record.id, lambda: record.already_exists(self.target_system))
+
+    def claim(self, ids: list[str]) -> bool:
+        """
+        Claims the insert of records for the calling transfer. Either all records are claimed or none,
+        so two transfers never wait for each other. If another transfer holds one of the claims, this
+        waits until it is released and returns False, the caller has to check the existence again.
+        :param ids: Ids of the records the caller would insert or change
+        :return: True if all records were claimed, they have to be released with `release`
+        """
+        with self._lock:
+            held = next((self._claims[id] for id in ids if id in self._claims), None)
+            if held is None:
+                for id in ids:
+                    self._claims[id] = threading.Event()
+                return True
+
+        held.wait()
+        return False
+
+    def release(self, ids: list[str]):
+        with self._lock:
+            for id in ids:
+                event = self._claims.pop(id, None)
+                if event is not None:
+                    event.set()
+
+    def mark_posted(self, record: Record, seen: set[str] = None):
+        """
+        Marks a posted record and all references inserted with it as existing in the target system.
+        :param record: The record which was posted successfully
+        :param seen: Ids already marked during this call
+        """
+        seen = seen if seen is not None else set()
+        if record.id in seen:
+            return
+        seen.add(record.id)
+
+        with self._lock:
+            future = Future()
+            future.set_result(True)
+            self._exists[record.id] = future
+
+        for reference in record.references.values():
+            if reference.key not in record.payload:
+                continue
+
+            ref_future = self._records.get(reference.id)
+            if ref_future is not None and ref_future.done() and ref_future.exception() is None:
+                ref_rec = ref_future.result()
+                if ref_rec is not None:
+                    self.mark_posted(ref_rec, seen)